@@ -0,0 +1,200 @@
+"""
+批量问答：从 JSONL 读取问题，在共享的 MCP 服务器上以有限并发逐条完成对话，
+结果在完成时立即追加写入输出 JSONL，结束时打印吞吐与延迟统计。
+
+输入每行一个 JSON 对象：{"id": "...", "query": "..."}，缺少 id 时以行号代替。
+输出每行：{"id", "query", "answer", "error", "latency_ms"}。
+再次以相同输出文件运行时，已成功完成的 id 会被跳过（断点续跑），
+失败的条目会重新处理。
+
+用法（在 mcp-client 目录下）：
+    python batch.py questions.jsonl answers.jsonl --concurrency 8
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+
+from client import (
+    Configuration,
+    ContextWindowManager,
+    MultiServerMCPClient,
+    current_session,
+)
+
+
+def read_queries(path: str) -> Iterator[Tuple[str, str]]:
+    """逐行读取输入文件，产出 (id, query)；格式错误的行记录日志后跳过"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+                query = str(item["query"]).strip()
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warning(f"跳过第 {line_no} 行: {e}")
+                continue
+            yield str(item.get("id", line_no)), query
+
+
+def completed_ids(path: str) -> Set[str]:
+    """读取已有输出文件中成功完成的 id，用于断点续跑"""
+    done: Set[str] = set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 中断时可能留下写了一半的最后一行
+                    continue
+                if record.get("error") is None:
+                    done.add(str(record["id"]))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def ends_with_newline(path: str) -> bool:
+    """文件为空、不存在或以换行结尾时返回 True"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+    except FileNotFoundError:
+        return True
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# =============================
+# 批量运行类
+# =============================
+class BatchRunner:
+    """以固定数量的 worker 并发处理问题，所有 worker 共享同一个客户端"""
+
+    def __init__(self, client: MultiServerMCPClient, concurrency: int = 8) -> None:
+        self.client = client
+        self.concurrency = concurrency
+        self.latencies: List[float] = []
+        self.failed = 0
+        self.skipped = 0
+
+    async def answer(self, query_id: str, query: str) -> Dict[str, Any]:
+        """独立上下文中完成一个问题，失败时在结果中记录错误而不抛出"""
+        token = current_session.set(query_id)
+        context = ContextWindowManager(None, self.client.context_max_tokens)
+        start = time.perf_counter()
+        answer: Optional[str] = None
+        error: Optional[str] = None
+        try:
+            message = await self.client.run_turn(context, query)
+            answer = message["content"]
+        except Exception as e:
+            error = str(e) or repr(e)
+        finally:
+            current_session.reset(token)
+        latency = time.perf_counter() - start
+        if error is None:
+            self.latencies.append(latency)
+        else:
+            self.failed += 1
+        return {
+            "id": query_id,
+            "query": query,
+            "answer": answer,
+            "error": error,
+            "latency_ms": round(latency * 1000, 1),
+        }
+
+    async def run(self, input_path: str, output: TextIO, skip: Set[str]) -> None:
+        """读取输入并分发给 worker；有界队列保证不会一次性读入整个文件"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker() -> None:
+            while (item := await queue.get()) is not None:
+                record = await self.answer(*item)
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            for query_id, query in read_queries(input_path):
+                if query_id in skip:
+                    self.skipped += 1
+                    continue
+                await queue.put((query_id, query))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    def summary(self, elapsed: float) -> str:
+        done = len(self.latencies)
+        lines = [
+            f"完成 {done} 条，失败 {self.failed} 条，跳过（已完成）{self.skipped} 条，"
+            f"耗时 {elapsed:.1f}s",
+            f"吞吐: {(done + self.failed) / elapsed:.2f} 条/s" if elapsed else "",
+        ]
+        if self.latencies:
+            lines.append(
+                "延迟: "
+                f"平均 {sum(self.latencies) / done * 1000:.0f}ms "
+                f"p50 {percentile(self.latencies, 0.5) * 1000:.0f}ms "
+                f"p90 {percentile(self.latencies, 0.9) * 1000:.0f}ms "
+                f"p99 {percentile(self.latencies, 0.99) * 1000:.0f}ms "
+                f"最大 {max(self.latencies) * 1000:.0f}ms"
+            )
+        return "\n".join(line for line in lines if line)
+
+
+# =============================
+# 主函数
+# =============================
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="MCP 客户端批量问答")
+    parser.add_argument("input", help="输入 JSONL 文件，每行 {id, query}")
+    parser.add_argument("output", help="输出 JSONL 文件（追加写入，支持断点续跑）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时处理的问题数")
+    parser.add_argument(
+        "--config", default="servers_config.json", help="MCP 服务器配置文件"
+    )
+    args = parser.parse_args()
+
+    config = Configuration()
+    servers_config = config.load_config(args.config)
+    client = MultiServerMCPClient()
+    runner = BatchRunner(client, args.concurrency)
+    skip = completed_ids(args.output)
+    if skip:
+        logging.info(f"已完成 {len(skip)} 条，将跳过")
+    start = time.perf_counter()
+    try:
+        await client.connect_to_servers(servers_config)
+        with open(args.output, "a", encoding="utf-8") as output:
+            # 上次中断可能留下没有换行结尾的半行，先补齐换行再追加
+            if not ends_with_newline(args.output):
+                output.write("\n")
+            await runner.run(args.input, output, skip)
+    finally:
+        await client.cleanup()
+        print(runner.summary(time.perf_counter() - start), flush=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
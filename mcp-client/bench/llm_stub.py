@@ -0,0 +1,117 @@
+"""
+本地 OpenAI 兼容的大模型桩服务，用于离线压测 MultiServerMCPClient。
+
+行为（按请求中的 model 名称 "stub-fanout-<k>" 决定扇出数 k）：
+  - 最后一条消息是 user：返回 k 个 tool_calls，依次分配到请求 tools 列表中的工具
+  - 最后一条消息是 tool：返回最终文本回答
+每次响应前等待 --latency 秒，模拟模型推理耗时。
+
+用法：
+    python bench/llm_stub.py --port 18080 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from typing import Any, Dict, List
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+_ids = itertools.count()
+
+
+def fake_arguments(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """根据工具的 parameters 生成一组合法参数"""
+    args: Dict[str, Any] = {}
+    for name, prop in schema.get("properties", {}).items():
+        prop_type = prop.get("type", "string")
+        if prop_type in ("integer", "number"):
+            args[name] = 1
+        elif prop_type == "boolean":
+            args[name] = True
+        elif prop_type == "array":
+            args[name] = ["Beijing"]
+        else:
+            args[name] = "Beijing"
+    return args
+
+
+def build_response(body: Dict[str, Any]) -> Dict[str, Any]:
+    model = body.get("model", "stub-fanout-1")
+    try:
+        fanout = int(model.rsplit("-", 1)[1])
+    except (IndexError, ValueError):
+        fanout = 1
+    messages: List[Dict[str, Any]] = body.get("messages", [])
+    # 内置的分页读取工具只在结果被转存时才有意义，不参与扇出
+    tools = [
+        t
+        for t in body.get("tools") or []
+        if t["function"]["name"] != "read_tool_output"
+    ]
+    message: Dict[str, Any] = {"role": "assistant", "content": None}
+    if messages and messages[-1].get("role") != "tool" and tools and fanout > 0:
+        tool_calls = []
+        for i in range(fanout):
+            function = tools[i % len(tools)]["function"]
+            tool_calls.append(
+                {
+                    "id": f"call_{next(_ids)}",
+                    "type": "function",
+                    "function": {
+                        "name": function["name"],
+                        "arguments": json.dumps(
+                            fake_arguments(function.get("parameters", {}))
+                        ),
+                    },
+                }
+            )
+        message["tool_calls"] = tool_calls
+        finish_reason = "tool_calls"
+    else:
+        message["content"] = "北京今天晴，气温 25°C。"
+        finish_reason = "stop"
+    prompt_chars = sum(len(str(m.get("content") or "")) for m in messages)
+    return {
+        "id": f"chatcmpl-{next(_ids)}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": {
+            "prompt_tokens": prompt_chars // 4 + 1,
+            "completion_tokens": 16,
+            "total_tokens": prompt_chars // 4 + 17,
+        },
+    }
+
+
+def create_app(latency: float) -> Starlette:
+    async def chat_completions(request: Request) -> JSONResponse:
+        body = await request.json()
+        if latency > 0:
+            await asyncio.sleep(latency)
+        return JSONResponse(build_response(body))
+
+    return Starlette(
+        routes=[Route("/v1/chat/completions", chat_completions, methods=["POST"])]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的本地桩服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="每次响应的延迟秒数"
+    )
+    args = parser.parse_args()
+    uvicorn.run(
+        create_app(args.latency), host=args.host, port=args.port, log_level="warning"
+    )
@@ -0,0 +1,251 @@
+"""
+MultiServerMCPClient 离线吞吐压测（不访问网络）。
+
+启动本地大模型桩服务（llm_stub.py）与若干合成 stdio MCP 服务器
+（synthetic_server.py），在不同的服务器数量、工具扇出与并发度组合下测量：
+  - 启动耗时（connect_to_servers）
+  - 吞吐（turns/s）与单轮延迟 p50 / p99
+  - 各阶段平均耗时（turn / round / llm / tool）以及客户端自身开销
+    （单轮平均耗时减去理论关键路径：有工具调用时为 2 次模型延迟 + 1 次工具延迟，
+    否则为 1 次模型延迟）
+
+--transport http / sse 时只启动一个常驻的合成 HTTP 服务器，
+所有服务器配置都指向它，用于对比 stdio 子进程与共享远程服务器。
+
+用法（在 mcp-client 目录下）：
+    python bench/run_bench.py --servers 1,4,8 --fanout 1,4 --concurrency 1,16
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from client import (  # noqa: E402
+    ContextWindowManager,
+    Metrics,
+    MultiServerMCPClient,
+    tracer,
+)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_port(port: int, timeout: float = 15.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"桩服务未在 {timeout}s 内启动")
+            await asyncio.sleep(0.05)
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def server_entry(args: argparse.Namespace, synth_env: Dict[str, str]) -> Dict[str, Any]:
+    """单个合成服务器的配置：stdio 子进程，或指向共享的 HTTP / SSE 服务器"""
+    entry: Dict[str, Any] = {"max_concurrency": args.server_concurrency}
+    if args.transport == "stdio":
+        entry.update(
+            command=sys.executable,
+            args=[os.path.join(BENCH_DIR, "synthetic_server.py")],
+            env=synth_env,
+        )
+    else:
+        path = "sse" if args.transport == "sse" else "mcp"
+        entry.update(
+            transport=args.transport,
+            url=f"http://127.0.0.1:{args.synth_port}/{path}",
+        )
+    return entry
+
+
+async def run_cell(
+    args: argparse.Namespace, servers: int, fanout: int, concurrency: int
+) -> Dict[str, Any]:
+    """在一组参数下完成启动、预热与压测，返回统计结果"""
+    os.environ["MODEL"] = f"stub-fanout-{fanout}"
+    tracer.metrics = Metrics()
+    synth_env = {
+        "SYNTH_LATENCY": str(args.tool_latency),
+        "SYNTH_PAYLOAD": str(args.payload),
+        "FASTMCP_LOG_LEVEL": "WARNING",
+    }
+    servers_config = {
+        "mcpServers": {
+            f"synth{i}": server_entry(args, synth_env) for i in range(servers)
+        }
+    }
+    client = MultiServerMCPClient()
+    try:
+        t0 = time.perf_counter()
+        await client.connect_to_servers(servers_config)
+        await client.wait_for_servers()
+        startup = time.perf_counter() - t0
+
+        # 预热一轮，排除首次连接建立等一次性开销
+        await client.run_turn(ContextWindowManager(None, 10**9), "北京天气怎么样")
+        tracer.metrics = Metrics()
+
+        latencies: List[float] = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one_turn() -> None:
+            async with semaphore:
+                context = ContextWindowManager(None, 10**9)
+                start = time.perf_counter()
+                await client.run_turn(context, "北京天气怎么样")
+                latencies.append(time.perf_counter() - start)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one_turn() for _ in range(args.turns)))
+        elapsed = time.perf_counter() - t0
+    finally:
+        await client.cleanup()
+
+    phases: Dict[str, List[float]] = {}
+    for labels, (total, count) in tracer.metrics.totals(
+        "mcp_span_duration_seconds"
+    ).items():
+        span = dict(labels)["span"]
+        acc = phases.setdefault(span, [0.0, 0])
+        acc[0] += total
+        acc[1] += count
+    phase_ms = {
+        span: round(total / count * 1000, 3) for span, (total, count) in phases.items()
+    }
+    turn_mean = sum(latencies) / len(latencies)
+    if fanout:
+        critical_path = 2 * args.llm_latency + args.tool_latency
+    else:
+        critical_path = args.llm_latency
+    return {
+        "servers": servers,
+        "fanout": fanout,
+        "concurrency": concurrency,
+        "turns": args.turns,
+        "startup_s": round(startup, 3),
+        "turns_per_s": round(args.turns / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "overhead_ms": round((turn_mean - critical_path) * 1000, 2),
+        "phase_mean_ms": phase_ms,
+    }
+
+
+def parse_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="MCP 工具调用循环离线压测")
+    parser.add_argument("--servers", type=parse_list, default=[1, 4])
+    parser.add_argument("--fanout", type=parse_list, default=[1, 4])
+    parser.add_argument("--concurrency", type=parse_list, default=[1, 8])
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--tool-latency", type=float, default=0.01)
+    parser.add_argument("--payload", type=int, default=0, help="工具结果附加字节数")
+    parser.add_argument("--server-concurrency", type=int, default=4)
+    parser.add_argument(
+        "--transport",
+        choices=["stdio", "http", "sse"],
+        default="stdio",
+        help="合成服务器的传输方式",
+    )
+    parser.add_argument("--json", dest="json_path", help="结果另存为 JSON 文件")
+    args = parser.parse_args()
+
+    port = free_port()
+    stub = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(BENCH_DIR, "llm_stub.py"),
+            "--port",
+            str(port),
+            "--latency",
+            str(args.llm_latency),
+        ]
+    )
+    synth = None
+    if args.transport != "stdio":
+        args.synth_port = free_port()
+        synth = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(BENCH_DIR, "synthetic_server.py"),
+                "--transport",
+                "sse" if args.transport == "sse" else "streamable-http",
+                "--port",
+                str(args.synth_port),
+            ],
+            env={
+                **os.environ,
+                "SYNTH_LATENCY": str(args.tool_latency),
+                "SYNTH_PAYLOAD": str(args.payload),
+                "FASTMCP_LOG_LEVEL": "WARNING",
+            },
+        )
+    os.environ["LLM_API_KEY"] = "bench"
+    os.environ["BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+    # 压测冷启动，不使用磁盘缓存的工具目录
+    os.environ["TOOL_CATALOG_CACHE"] = ""
+    os.environ["MCP_SUPERVISOR_INTERVAL"] = "0"
+    # 每轮都是同一个问题，关闭回答缓存以测量完整的工具调用循环
+    os.environ["ANSWER_CACHE_MAX_ENTRIES"] = "0"
+    tracer.configure(metrics=True)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    try:
+        await wait_for_port(port)
+        if synth is not None:
+            await wait_for_port(args.synth_port)
+        for servers in args.servers:
+            for fanout in args.fanout:
+                for concurrency in args.concurrency:
+                    result = await run_cell(args, servers, fanout, concurrency)
+                    results.append(result)
+                    print(
+                        f"servers={servers:<3} fanout={fanout:<3} "
+                        f"concurrency={concurrency:<4} "
+                        f"startup={result['startup_s']:.3f}s "
+                        f"throughput={result['turns_per_s']:.2f} turns/s "
+                        f"p50={result['p50_ms']:.1f}ms p99={result['p99_ms']:.1f}ms "
+                        f"overhead={result['overhead_ms']:.1f}ms",
+                        flush=True,
+                    )
+    finally:
+        for process in (stub, synth):
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
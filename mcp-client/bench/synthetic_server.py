@@ -0,0 +1,60 @@
+"""
+合成的 stdio MCP 服务器，仿照 weather_server.py / write_server.py 提供同名工具，
+但不访问网络：按 SYNTH_LATENCY 秒休眠后返回固定格式的结果，
+结果大小可通过 SYNTH_PAYLOAD（字节）放大，用于测量序列化开销。
+
+默认以 stdio 方式运行；也可作为本地常驻的 HTTP / SSE 服务器，供多个客户端共享：
+    python bench/synthetic_server.py --transport streamable-http --port 18100
+客户端配置 {"transport": "http", "url": "http://127.0.0.1:18100/mcp"}
+（SSE 为 {"transport": "sse", "url": "http://127.0.0.1:18100/sse"}）。
+"""
+
+import argparse
+import asyncio
+import os
+
+from mcp.server.fastmcp import FastMCP
+
+mcp = FastMCP("SyntheticServer")
+
+LATENCY = float(os.getenv("SYNTH_LATENCY", "0.01"))
+PAYLOAD = int(os.getenv("SYNTH_PAYLOAD", "0"))
+
+
+@mcp.tool()
+async def query_weather(city: str) -> str:
+    """
+    输入指定城市的英文名称，返回今日天气查询结果。
+    :param city: 城市名称（需使用英文）
+    :return: 格式化后的天气信息
+    """
+    if LATENCY > 0:
+        await asyncio.sleep(LATENCY)
+    return (
+        f"🌍 {city}, CN\n🌡 温度: 25°C\n💧 湿度: 40%\n🌬 风速: 3 m/s\n🌤 天气: 晴\n"
+    ) + "." * PAYLOAD
+
+
+@mcp.tool()
+async def write_file(content: str) -> str:
+    """
+    将指定内容写入本地文件。
+    :param content: 必要参数，字符串类型，用于表示需要写入文档的具体内容。
+    :return：是否成功写入
+    """
+    if LATENCY > 0:
+        await asyncio.sleep(LATENCY)
+    return "已成功写入本地文件。"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="合成 MCP 服务器")
+    parser.add_argument(
+        "--transport", choices=["stdio", "sse", "streamable-http"], default="stdio"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18100)
+    args = parser.parse_args()
+    mcp.settings.host = args.host
+    mcp.settings.port = args.port
+    mcp.run(transport=args.transport)
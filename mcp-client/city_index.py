@@ -0,0 +1,302 @@
+"""
+离线城市名称索引：在请求 OpenWeather 之前把中文名、别名与拼写有误的英文名
+解析为规范的城市名与国家代码（OpenWeather 的 q 参数形如 "Beijing,CN"）。
+
+索引以 docs/数据/global_cities_data.csv 为种子，加上内置的中文名 / 别名表，
+并可通过 JSON 文件扩展：{"Hangzhou,CN": ["杭州", "临安"], ...}。
+精确匹配是一次字典查找；带国家限定的写法（"London,GB"、"Paris, France"）
+只匹配该国的城市。可选的模糊匹配允许英文名有一处拼写错误（增、删、改或相邻
+字母颠倒），通过预先计算的"删除一个字符"邻域查找，不需要逐个比较；
+它会把索引外的真实城市（如巴西的 Lages）映射到相近的已知城市（Lagos），
+因此只应在原名查询失败后使用。
+"""
+
+import csv
+import json
+import logging
+import re
+import unicodedata
+from collections.abc import Iterable
+from typing import NamedTuple
+
+# CSV 中的国家名 -> ISO 3166 国家代码
+COUNTRY_CODES = {
+    "Angola": "AO",
+    "Argentina": "AR",
+    "Australia": "AU",
+    "Bangladesh": "BD",
+    "Brazil": "BR",
+    "Canada": "CA",
+    "China": "CN",
+    "Colombia": "CO",
+    "Congo": "CD",
+    "Egypt": "EG",
+    "France": "FR",
+    "India": "IN",
+    "Indonesia": "ID",
+    "Iran": "IR",
+    "Japan": "JP",
+    "Malaysia": "MY",
+    "Mexico": "MX",
+    "Nigeria": "NG",
+    "Pakistan": "PK",
+    "Peru": "PE",
+    "Philippines": "PH",
+    "Russia": "RU",
+    "Singapore": "SG",
+    "Spain": "ES",
+    "Thailand": "TH",
+    "Turkey": "TR",
+    "United Kingdom": "GB",
+    "United States": "US",
+    "Vietnam": "VN",
+}
+
+# 常见的非 ISO 国家写法
+COUNTRY_SYNONYMS = {"uk": "GB", "usa": "US", "britain": "GB", "greatbritain": "GB"}
+
+# 内置别名："城市名,国家代码" -> 中文名与常见别名。
+# 不在 CSV 中的城市（如杭州）也会以此加入索引。
+CITY_ALIASES: dict[str, list[str]] = {
+    "Tokyo,JP": ["东京"],
+    "Delhi,IN": ["德里", "新德里", "New Delhi"],
+    "Shanghai,CN": ["上海", "魔都"],
+    "Dhaka,BD": ["达卡"],
+    "São Paulo,BR": ["圣保罗"],
+    "Cairo,EG": ["开罗"],
+    "Mexico City,MX": ["墨西哥城"],
+    "Beijing,CN": ["北京", "帝都", "Peking"],
+    "Mumbai,IN": ["孟买", "Bombay"],
+    "Osaka,JP": ["大阪"],
+    "Chongqing,CN": ["重庆", "山城"],
+    "Karachi,PK": ["卡拉奇"],
+    "Istanbul,TR": ["伊斯坦布尔"],
+    "Kinshasa,CD": ["金沙萨"],
+    "Lagos,NG": ["拉各斯"],
+    "Buenos Aires,AR": ["布宜诺斯艾利斯"],
+    "Kolkata,IN": ["加尔各答", "Calcutta"],
+    "Manila,PH": ["马尼拉"],
+    "Tianjin,CN": ["天津"],
+    "Guangzhou,CN": ["广州", "羊城", "Canton"],
+    "Rio de Janeiro,BR": ["里约热内卢", "里约", "Rio"],
+    "Lahore,PK": ["拉合尔"],
+    "Bangalore,IN": ["班加罗尔", "Bengaluru"],
+    "Shenzhen,CN": ["深圳", "鹏城"],
+    "Moscow,RU": ["莫斯科"],
+    "Chennai,IN": ["金奈", "Madras"],
+    "Bogotá,CO": ["波哥大"],
+    "Paris,FR": ["巴黎"],
+    "Jakarta,ID": ["雅加达"],
+    "Lima,PE": ["利马"],
+    "Bangkok,TH": ["曼谷"],
+    "London,GB": ["伦敦"],
+    "Tehran,IR": ["德黑兰"],
+    "Nanjing,CN": ["南京", "金陵", "Nanking"],
+    "Ho Chi Minh City,VN": ["胡志明市", "西贡", "Saigon"],
+    "Luanda,AO": ["罗安达"],
+    "New York,US": ["纽约", "New York City", "NYC"],
+    "Pune,IN": ["浦那"],
+    "Surat,IN": ["苏拉特"],
+    "Hyderabad,IN": ["海得拉巴"],
+    "Ahmedabad,IN": ["艾哈迈达巴德"],
+    "Kuala Lumpur,MY": ["吉隆坡", "KL"],
+    "Xiamen,CN": ["厦门", "鹭岛", "Amoy"],
+    "Singapore,SG": ["新加坡", "狮城"],
+    "Sydney,AU": ["悉尼", "雪梨"],
+    "Toronto,CA": ["多伦多"],
+    "Madrid,ES": ["马德里"],
+    "Philadelphia,US": ["费城"],
+    "Wuhan,CN": ["武汉", "江城"],
+    "Dalian,CN": ["大连"],
+    "Hanoi,VN": ["河内"],
+    "Barcelona,ES": ["巴塞罗那"],
+    "Miami,US": ["迈阿密"],
+    "Phoenix,US": ["菲尼克斯", "凤凰城"],
+    "Hangzhou,CN": ["杭州"],
+    "Chengdu,CN": ["成都", "蓉城"],
+    "Xi'an,CN": ["西安", "Xian"],
+    "Suzhou,CN": ["苏州"],
+    "Qingdao,CN": ["青岛"],
+    "Harbin,CN": ["哈尔滨"],
+    "Shenyang,CN": ["沈阳"],
+    "Changsha,CN": ["长沙"],
+    "Zhengzhou,CN": ["郑州"],
+    "Kunming,CN": ["昆明", "春城"],
+    "Lhasa,CN": ["拉萨"],
+    "Hong Kong,HK": ["香港"],
+    "Macau,MO": ["澳门", "Macao"],
+    "Taipei,TW": ["台北"],
+    "Seoul,KR": ["首尔", "汉城"],
+    "Los Angeles,US": ["洛杉矶", "LA"],
+    "San Francisco,US": ["旧金山", "三藩市"],
+    "Berlin,DE": ["柏林"],
+    "Rome,IT": ["罗马"],
+    "Dubai,AE": ["迪拜"],
+}
+
+# 允许一处拼写错误的最短名称长度，过短的名称容易误匹配
+FUZZY_MIN_LENGTH = 5
+
+
+class City(NamedTuple):
+    name: str
+    country: str
+
+    @property
+    def query(self) -> str:
+        """OpenWeather 的 q 参数"""
+        return f"{self.name},{self.country}"
+
+
+def normalize_name(text: str) -> str:
+    """规范化城市名：去重音、转小写、去掉空白与标点，以及中文名末尾的"市"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    text = re.sub(r"[\W_]+", "", text)
+    if len(text) > 2 and text.endswith("市"):
+        text = text[:-1]
+    return text
+
+
+def _deletes(key: str) -> set[str]:
+    return {key[:i] + key[i + 1 :] for i in range(len(key))}
+
+
+def _within_one_edit(a: str, b: str) -> bool:
+    """a 与 b 是否只差一处增、删、改或相邻字符颠倒"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        diff = [i for i in range(len(a)) if a[i] != b[i]]
+        if len(diff) == 1:
+            return True
+        return (
+            len(diff) == 2
+            and diff[1] == diff[0] + 1
+            and a[diff[0]] == b[diff[1]]
+            and a[diff[1]] == b[diff[0]]
+        )
+    shorter, longer = sorted((a, b), key=len)
+    return any(longer[:i] + longer[i + 1 :] == shorter for i in range(len(longer)))
+
+
+class CityIndex:
+    """城市名称 -> City 的内存索引，支持精确匹配与一处拼写错误的模糊匹配"""
+
+    def __init__(self) -> None:
+        self._exact: dict[str, City] = {}
+        # 删除一个字符后的键 -> 原键集合，用于模糊匹配
+        self._deletes: dict[str, set[str]] = {}
+        # 城市的添加顺序（CSV 按人口排序），模糊匹配有多个候选时优先靠前的城市
+        self._rank: dict[City, int] = {}
+        # 规范化的国家名 -> 国家代码，用于解析 "Paris, France" 中的国家限定
+        self._countries: dict[str, str] = {
+            normalize_name(name): code for name, code in COUNTRY_CODES.items()
+        }
+        self._countries.update(COUNTRY_SYNONYMS)
+
+    def __len__(self) -> int:
+        return len(self._rank)
+
+    def add(self, city: City, aliases: Iterable[str] = ()) -> None:
+        """添加城市及其别名；已存在的名称不会被覆盖"""
+        self._rank.setdefault(city, len(self._rank))
+        for alias in [city.name, *aliases]:
+            key = normalize_name(alias)
+            if not key or key in self._exact:
+                continue
+            self._exact[key] = city
+            if key.isascii() and len(key) >= FUZZY_MIN_LENGTH:
+                for deleted in _deletes(key):
+                    self._deletes.setdefault(deleted, set()).add(key)
+
+    def add_aliases(self, aliases: dict[str, list[str]]) -> None:
+        """按 {"城市名,国家代码": [别名, ...]} 添加城市与别名"""
+        for query, names in aliases.items():
+            name, _, country = query.rpartition(",")
+            if not name:
+                name, country = country, ""
+            self.add(City(name.strip(), country.strip().upper()), names)
+
+    def load_csv(self, path: str) -> None:
+        """从城市数据 CSV（需包含 City 与 Country 列）载入城市"""
+        with open(path, "r", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                name = (row.get("City") or "").strip()
+                if name:
+                    country = COUNTRY_CODES.get(row.get("Country", "").strip(), "")
+                    self.add(City(name, country))
+
+    def load_aliases(self, path: str) -> None:
+        """从 JSON 文件载入扩展的别名表"""
+        with open(path, "r", encoding="utf-8") as f:
+            self.add_aliases(json.load(f))
+
+    def _country(self, qualifier: str) -> str | None:
+        """逗号后的限定词对应的国家代码；不是国家（如州名 "Texas"、"OH"）时返回 None"""
+        key = normalize_name(qualifier)
+        if key in self._countries:
+            return self._countries[key]
+        if len(key) == 2 and key.isascii() and key.isalpha():
+            return key.upper()
+        return None
+
+    def resolve(self, text: str, fuzzy: bool = False) -> City | None:
+        """
+        解析城市名。"Beijing, China" 之类带国家的写法只接受该国的城市；
+        限定词不是国家（如 "Paris, Texas"）时返回 None，由调用方原样查询。
+        fuzzy 为 True 时，精确匹配失败后允许一处拼写错误。
+        """
+        name, _, qualifier = text.partition(",")
+        country = None
+        if qualifier.strip():
+            country = self._country(qualifier)
+            if country is None:
+                return None
+        city = self._match(normalize_name(name), fuzzy)
+        if city is None or (country is not None and city.country != country):
+            return None
+        return city
+
+    def _match(self, key: str, fuzzy: bool) -> City | None:
+        city = self._exact.get(key)
+        if (
+            city is not None
+            or not fuzzy
+            or not key.isascii()
+            or len(key) < FUZZY_MIN_LENGTH - 1
+        ):
+            return city
+        # 候选：多一个字符、少一个字符、替换或颠倒一个字符的已知名称
+        candidates = set(self._deletes.get(key, ()))
+        for deleted in _deletes(key):
+            if deleted in self._exact:
+                candidates.add(deleted)
+            candidates.update(self._deletes.get(deleted, ()))
+        matches = {
+            self._exact[candidate]
+            for candidate in candidates
+            if _within_one_edit(key, candidate)
+        }
+        if not matches:
+            return None
+        return min(matches, key=self._rank.__getitem__)
+
+
+def build_index(csv_path: str | None, aliases_path: str | None = None) -> CityIndex:
+    """以 CSV 为种子，加上内置别名与可选的扩展别名文件构建索引"""
+    index = CityIndex()
+    if csv_path:
+        try:
+            index.load_csv(csv_path)
+        except OSError as e:
+            logging.warning(f"无法读取城市数据 {csv_path}: {e}")
+    index.add_aliases(CITY_ALIASES)
+    if aliases_path:
+        try:
+            index.load_aliases(aliases_path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"无法读取城市别名文件 {aliases_path}: {e}")
+    return index
@@ -1,20 +1,418 @@
 import asyncio
+import base64
+import hashlib
 import json
 import logging
 import os
-from contextlib import AsyncExitStack
-from typing import Any, Dict, List, Optional
+import math
+import mimetypes
+import random
+import re
+import time
+import unicodedata
+from collections import Counter, OrderedDict, deque
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from contextvars import ContextVar, copy_context
+from functools import lru_cache
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI  # OpenAI Python SDK
+from openai import AsyncOpenAI  # OpenAI Python SDK
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 from mcp import ClientSession, StdioServerParameters
+from mcp.types import CallToolResult
+from mcp.client.sse import sse_client
 from mcp.client.stdio import stdio_client
+from mcp.client.streamable_http import streamablehttp_client
+
+try:  # 精确计算 token 数；导入失败时退化为按字符估算
+    import tiktoken
+except ImportError:  # pragma: no cover
+    tiktoken = None
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# 单个服务器启动（initialize + list_tools）的默认超时秒数，可在 servers_config.json
+# 中通过 "startup_timeout" 按服务器覆盖
+DEFAULT_STARTUP_TIMEOUT = 30.0
+# 单个服务器默认允许同时进行的工具调用数，可通过 "max_concurrency" 按服务器覆盖
+DEFAULT_MAX_CONCURRENCY = 4
+# 关闭服务器时等待子进程退出的秒数
+SERVER_SHUTDOWN_TIMEOUT = 5.0
+# 健康检查（ping）的超时秒数
+HEALTH_CHECK_TIMEOUT = 5.0
+# 单次工具调用的默认截止时间（秒），可通过服务器级 "call_timeout" 或
+# "tools" 下的工具级 "timeout" 覆盖
+DEFAULT_CALL_TIMEOUT = 60.0
+# 指数退避的最大等待秒数
+MAX_RETRY_DELAY = 10.0
+# HTTP / SSE 传输的默认请求超时与 SSE 流读取超时（秒），可通过 "http_timeout"
+# 与 "sse_read_timeout" 按服务器覆盖
+DEFAULT_HTTP_TIMEOUT = 30.0
+DEFAULT_SSE_READ_TIMEOUT = 300.0
+# "transport" 配置值到内部传输名称的映射
+TRANSPORTS = {
+    "stdio": "stdio",
+    "sse": "sse",
+    "http": "streamable_http",
+    "streamable_http": "streamable_http",
+    "streamable-http": "streamable_http",
+}
+
+# 内置的分页读取工具名，用于读取被转存到磁盘的大型工具结果
+READ_OUTPUT_TOOL = "read_tool_output"
+
+# 当前对话会话的标识，多会话服务模式下用于工具调用的公平调度
+current_session: ContextVar[str] = ContextVar("current_session", default="default")
+
+# 本轮对话中返回了不可缓存结果（_meta 中 cacheable 为 false，如限流时的旧天气数据）
+# 的工具名；工具调用在子任务中进行，因此共享同一个列表而不是重新设置变量
+uncacheable_results: ContextVar[Optional[List[str]]] = ContextVar(
+    "uncacheable_results", default=None
+)
+
+
+# =============================
+# 链路追踪与指标
+# =============================
+class Metrics:
+    """进程内指标（直方图 + 计数器），以 Prometheus 文本格式导出"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self) -> None:
+        # (指标名, 标签) -> [各桶计数..., 总和, 次数]
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    @staticmethod
+    def _labels(labels: Tuple[Tuple[str, str], ...], **extra: str) -> str:
+        pairs = list(labels) + list(extra.items())
+        if not pairs:
+            return ""
+        escaped = []
+        for k, v in pairs:
+            v = v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{k}="{v}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def totals(self, name: str) -> Dict[Tuple[Tuple[str, str], ...], Tuple[float, int]]:
+        """返回某个直方图各标签组合的 (总和, 次数)"""
+        return {
+            labels: (histogram[-2], histogram[-1])
+            for (metric, labels), histogram in self._histograms.items()
+            if metric == name
+        }
+
+    def render(self) -> str:
+        """生成 Prometheus 文本格式（exposition format 0.0.4）"""
+        lines: List[str] = []
+        typed = set()
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in zip(self.BUCKETS, histogram):
+                lines.append(
+                    f"{name}_bucket{self._labels(labels, le=str(bound))} {count}"
+                )
+            lines.append(
+                f"{name}_bucket{self._labels(labels, le='+Inf')} {histogram[-1]}"
+            )
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram[-1]}")
+        for (name, labels), value in sorted(self._counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Span:
+    """一次计时区间（LLM 调用、工具调用、一轮或一整个对话轮次）"""
+
+    __slots__ = ("name", "attrs", "trace_id", "span_id", "parent_id", "start", "_t0")
+
+    def __init__(self, name: str, attrs: Dict[str, Any], parent: Optional["Span"]):
+        self.name = name
+        self.attrs = attrs
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+
+class _NoopSpan:
+    """追踪关闭时使用的空 span，进入/退出与 set 均为空操作"""
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        return None
+
+
+_NOOP_SPAN = _NoopSpan()
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """记录各阶段耗时：导出为 JSON Lines 文件，并汇总为 Prometheus 指标
+
+    未启用时 span() 直接返回共享的空 span，几乎没有额外开销。
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.metrics = Metrics()
+        self._trace_file: Optional[Any] = None
+
+    def configure(self, trace_file: Optional[str] = None, metrics: bool = False):
+        """启用追踪：trace_file 为 JSON Lines 输出路径，metrics 为是否汇总指标"""
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+        if trace_file:
+            self._trace_file = open(trace_file, "a", encoding="utf-8", buffering=1)
+        self.enabled = bool(trace_file or metrics)
+
+    def span(self, name: str, **attrs: Any) -> Any:
+        if not self.enabled:
+            return _NOOP_SPAN
+        return self._span(name, attrs)
+
+    def annotate(self, **attrs: Any) -> None:
+        """给当前 span 添加属性"""
+        if self.enabled:
+            span = _current_span.get()
+            if span is not None:
+                span.attrs.update(attrs)
+
+    @contextmanager
+    def _span(self, name: str, attrs: Dict[str, Any]) -> Iterator[Span]:
+        span = Span(name, attrs, _current_span.get())
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs.setdefault("error", type(e).__name__)
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish(span, time.perf_counter() - span._t0)
+
+    def _finish(self, span: Span, duration: float) -> None:
+        labels = {k: span.attrs[k] for k in ("server", "tool") if k in span.attrs}
+        self.metrics.observe(
+            "mcp_span_duration_seconds", duration, span=span.name, **labels
+        )
+        for kind in ("prompt", "completion"):
+            tokens = span.attrs.get(f"{kind}_tokens")
+            if tokens:
+                self.metrics.inc("mcp_llm_tokens_total", tokens, type=kind)
+        if span.name == "turn" and "rounds" in span.attrs:
+            self.metrics.observe("mcp_turn_rounds", span.attrs["rounds"])
+        if "error" in span.attrs:
+            self.metrics.inc("mcp_span_errors_total", span=span.name, **labels)
+        if self._trace_file is not None:
+            record = {
+                "name": span.name,
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "start": span.start,
+                "duration_ms": round(duration * 1000, 3),
+                **span.attrs,
+            }
+            self._trace_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+# 进程级追踪器，由 MultiServerMCPClient 根据配置启用
+tracer = Tracer()
+
+
+async def start_metrics_server(host: str, port: int) -> asyncio.AbstractServer:
+    """启动一个极简 HTTP 服务，任意路径均返回 Prometheus 文本格式的指标"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = tracer.metrics.render().encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+# =============================
+# 录制 / 回放类
+# =============================
+class CassetteMissError(LookupError):
+    """回放时 cassette 中没有与请求匹配的记录"""
+
+
+class Cassette:
+    """将 LLM 请求、工具列表与工具调用录制到 JSON Lines 文件，或从文件中回放
+
+    流式 LLM 请求以分片列表的形式整体录制，回放时逐个分片返回。
+    每条记录以请求内容的哈希为键。回放时同一请求的多条记录按录制顺序依次返回，
+    用完后重复返回最后一条；timing 为 "original" 时按录制时的耗时等待后再返回，
+    为 "fast" 时立即返回。
+    """
+
+    def __init__(self) -> None:
+        self.mode: Optional[str] = None
+        self.timing = "fast"
+        self._file: Optional[Any] = None
+        self._entries: Dict[str, Deque[Dict[str, Any]]] = {}
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == "record"
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def configure(self, path: str, mode: str = "record", timing: str = "fast"):
+        """启用录制（追加写入 path）或回放（读取 path）"""
+        if mode not in ("record", "replay"):
+            raise ValueError(f"未知的 cassette 模式: {mode}")
+        self.close()
+        self.mode = mode
+        self.timing = timing
+        if mode == "record":
+            self._file = open(path, "a", encoding="utf-8", buffering=1)
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries.setdefault(entry["key"], deque()).append(entry)
+
+    @staticmethod
+    def make_key(kind: str, request: Any) -> str:
+        raw = json.dumps([kind, request], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def record(
+        self,
+        kind: str,
+        request: Any,
+        elapsed: float,
+        response: Any = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        """录制一次交互；未处于录制模式时什么也不做"""
+        if not self.recording:
+            return
+        entry = {
+            "kind": kind,
+            "key": self.make_key(kind, request),
+            "elapsed": round(elapsed, 6),
+            "request": request,
+        }
+        if error is not None:
+            entry["error"] = {"type": type(error).__name__, "message": str(error)}
+        else:
+            entry["response"] = response
+        self._file.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+    async def replay(self, kind: str, request: Any) -> Any:
+        """返回与请求匹配的录制结果，录制时失败的交互重新抛出对应异常"""
+        entries = self._entries.get(self.make_key(kind, request))
+        if not entries:
+            raise CassetteMissError(f"cassette 中没有匹配的 {kind} 请求")
+        entry = entries.popleft() if len(entries) > 1 else entries[0]
+        if self.timing == "original":
+            await asyncio.sleep(entry["elapsed"])
+        error = entry.get("error")
+        if error is not None:
+            if error["type"] == "TimeoutError":
+                raise TimeoutError(error["message"])
+            raise RuntimeError(error["message"])
+        return entry["response"]
+
+    async def record_stream(
+        self, stream: Any, kind: str, request: Any, start: float
+    ) -> AsyncIterator[Any]:
+        """转发流式响应的分片，流完整结束（或出错）后录制全部分片"""
+        chunks: List[Dict[str, Any]] = []
+        try:
+            async for chunk in stream:
+                chunks.append(chunk.model_dump(mode="json"))
+                yield chunk
+        except Exception as e:
+            self.record(kind, request, time.perf_counter() - start, error=e)
+            raise
+        self.record(kind, request, time.perf_counter() - start, response=chunks)
+
+    @staticmethod
+    async def replay_stream(
+        chunks: List[Dict[str, Any]],
+    ) -> AsyncIterator[ChatCompletionChunk]:
+        """以流的形式返回 replay 取得的分片"""
+        for chunk in chunks:
+            yield ChatCompletionChunk.model_validate(chunk)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._entries.clear()
+        self.mode = None
+
+
+# 进程级 cassette，由 MultiServerMCPClient 根据配置启用
+cassette = Cassette()
+
 
 # =============================
 # 配置加载类（支持环境变量及配置文件）
@@ -30,6 +428,74 @@ class Configuration:
         self.model = os.getenv("MODEL")
         if not self.api_key:
             raise ValueError("❌ 未找到 LLM_API_KEY，请在 .env 文件中配置")
+        # LLM HTTP 连接池配置
+        self.llm_max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+        self.llm_max_keepalive = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+        self.llm_keepalive_expiry = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+        self.llm_timeout = float(os.getenv("LLM_TIMEOUT", "120"))
+        self.llm_connect_timeout = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+        # 工具结果缓存的最大条目数
+        self.tool_cache_max_entries = int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "256"))
+        # 工具目录磁盘缓存文件，置空则禁用（每次启动都等待 list_tools）
+        self.tool_catalog_cache = os.getenv(
+            "TOOL_CATALOG_CACHE", ".mcp_tool_catalog.json"
+        )
+        # 服务器监管任务的巡检间隔（空闲回收与健康检查），0 表示关闭
+        self.supervisor_interval = float(os.getenv("MCP_SUPERVISOR_INTERVAL", "10"))
+        # 对话上下文的 token 预算（超出时按整轮淘汰最早的对话并后台摘要）
+        self.context_max_tokens = int(os.getenv("CONTEXT_MAX_TOKENS", "8000"))
+        # 链路追踪：JSON Lines 输出文件；指标：是否汇总及独立指标端口（0 为不启动）
+        self.trace_file = os.getenv("TRACE_FILE", "")
+        self.metrics_port = int(os.getenv("METRICS_PORT", "0"))
+        self.metrics_enabled = self.metrics_port > 0 or os.getenv(
+            "METRICS_ENABLED", "false"
+        ).lower() in ("1", "true", "yes")
+        # 大型工具结果的转存目录，超过 TOOL_OUTPUT_INLINE_LIMIT 字符的结果转存后
+        # 只在上下文中保留预览与句柄（0 表示不转存），分页读取时每页字符数
+        self.tool_output_dir = os.getenv("TOOL_OUTPUT_DIR", ".mcp_tool_outputs")
+        self.tool_output_inline_limit = int(
+            os.getenv("TOOL_OUTPUT_INLINE_LIMIT", "4000")
+        )
+        self.tool_output_preview = int(os.getenv("TOOL_OUTPUT_PREVIEW", "800"))
+        self.tool_output_page_size = int(os.getenv("TOOL_OUTPUT_PAGE_SIZE", "4000"))
+        # 转存目录的总大小上限（字节）与文件最长保留秒数，超出后按最近使用时间
+        # 从旧到新删除（0 表示不限制）
+        self.tool_output_max_bytes = int(
+            os.getenv("TOOL_OUTPUT_MAX_BYTES", str(256 * 1024 * 1024))
+        )
+        self.tool_output_max_age = float(
+            os.getenv("TOOL_OUTPUT_MAX_AGE", str(7 * 24 * 3600))
+        )
+        # 每轮按相关性挑选的工具数（0 表示始终发送全部工具），以及保留的最近使用工具数
+        self.tool_top_k = int(os.getenv("TOOL_TOP_K", "8"))
+        self.tool_sticky = int(os.getenv("TOOL_STICKY", "4"))
+        # 单轮对话预算：工具调用轮数、累计 token 数与墙钟秒数（0 表示不限制），
+        # 预算耗尽后强制进行一次不允许调用工具的最终回答，其耗时上限为 TURN_FINAL_TIMEOUT
+        self.turn_max_rounds = int(os.getenv("TURN_MAX_ROUNDS", "8"))
+        self.turn_max_tokens = int(os.getenv("TURN_MAX_TOKENS", "0"))
+        self.turn_timeout = float(os.getenv("TURN_TIMEOUT", "120"))
+        self.turn_final_timeout = float(os.getenv("TURN_FINAL_TIMEOUT", "30"))
+        # 回答缓存：无上下文的问题按规范化文本（只统一全半角、大小写与空白）精确匹配；
+        # ANSWER_CACHE_MAX_ENTRIES 为 0 时关闭。调用过工具的回答最多缓存 ANSWER_CACHE_TTL 秒，
+        # 没有调用工具的回答缺少判断新鲜度的依据，默认不缓存（ANSWER_CACHE_TOOLLESS_TTL）。
+        # 配置了 EMBEDDING_MODEL 时，另按模型服务 embeddings 的余弦相似度做语义匹配
+        # （不低于 ANSWER_CACHE_THRESHOLD，且两个问题中的数字与专有名词必须一致）
+        self.answer_cache_max_entries = int(
+            os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512")
+        )
+        self.answer_cache_threshold = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.9"))
+        self.answer_cache_ttl = float(os.getenv("ANSWER_CACHE_TTL", "600"))
+        self.answer_cache_toolless_ttl = float(
+            os.getenv("ANSWER_CACHE_TOOLLESS_TTL", "0")
+        )
+        self.embedding_model = os.getenv("EMBEDDING_MODEL", "")
+        # 录制 / 回放：CASSETTE_MODE 为 record 或 replay，
+        # CASSETTE_TIMING 为 fast（立即返回）或 original（按录制时的耗时回放）
+        self.cassette_file = os.getenv("CASSETTE_FILE", "")
+        self.cassette_mode = os.getenv("CASSETTE_MODE", "record")
+        self.cassette_timing = os.getenv("CASSETTE_TIMING", "fast")
+        # 是否以流式方式输出回答
+        self.stream = os.getenv("LLM_STREAM", "false").lower() in ("1", "true", "yes")
 
     @staticmethod
     def load_config(file_path: str) -> Dict[str, Any]:
@@ -39,205 +505,1634 @@ class Configuration:
         Args:
             file_path: JSON 配置文件路径
 
-        Returns:
-            包含服务器配置的字典
-        """
-        with open(file_path, "r") as f:
-            return json.load(f)
+        Returns:
+            包含服务器配置的字典
+        """
+        with open(file_path, "r") as f:
+            return json.load(f)
+
+
+# =============================
+# 熔断器
+# =============================
+class CircuitOpenError(RuntimeError):
+    """服务器处于熔断状态，调用被直接拒绝"""
+
+    def __init__(self, server_name: str, retry_after: float) -> None:
+        super().__init__(f"Server {server_name} is unavailable (circuit open)")
+        self.server_name = server_name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """按服务器统计连续失败，达到阈值后熔断
+
+    状态：closed（正常）-> open（快速失败）-> 冷却 reset_timeout 秒后 half_open
+    （放行一次试探调用）-> 成功则 closed，失败则重新 open。
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        """是否允许本次调用"""
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._trial_in_flight = False
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def retry_after(self) -> float:
+        """距离下一次允许试探的秒数"""
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """放行的调用被取消（未得出成败）时释放试探名额，允许下一次调用重新试探"""
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self._trial_in_flight = False
+        if (
+            self.state == "half_open"
+            or self.consecutive_failures >= self.failure_threshold
+        ):
+            if self.state != "open":
+                self.trips += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+# =============================
+# MCP 服务器客户端类
+# =============================
+class Server:
+    """管理单个 MCP 服务器连接和工具调用"""
+
+    def __init__(self, name: str, config: Dict[str, Any]) -> None:
+        self.name: str = name
+        self.config: Dict[str, Any] = config
+        self.session: Optional[ClientSession] = None
+        transport = config.get("transport", "stdio")
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Server {name} 使用了不支持的传输方式: {transport}")
+        self.transport: str = TRANSPORTS[transport]
+        self._runner: Optional[asyncio.Task] = None
+        self._stop_event = asyncio.Event()
+        self._cleanup_lock = asyncio.Lock()
+        # 限制同一服务器上同时进行的工具调用数，避免单个 stdio 服务器被打满
+        self.max_concurrency: int = config.get(
+            "max_concurrency", DEFAULT_MAX_CONCURRENCY
+        )
+        self._call_semaphore = asyncio.Semaphore(self.max_concurrency)
+        # 生命周期管理：懒启动、空闲回收与健康检查（由 ServerSupervisor 驱动）
+        self.lazy: bool = config.get("lazy", False)
+        self.idle_timeout: float = config.get("idle_timeout", 0)
+        self.health_check: bool = config.get("health_check", True)
+        self.startup_timeout: float = config.get(
+            "startup_timeout", DEFAULT_STARTUP_TIMEOUT
+        )
+        # 重试、截止时间与熔断配置
+        self.retries: int = config.get("retries", 2)
+        self.call_timeout: float = config.get("call_timeout", DEFAULT_CALL_TIMEOUT)
+        self.breaker = CircuitBreaker(
+            config.get("breaker_threshold", 5),
+            config.get("breaker_reset_timeout", 30.0),
+        )
+        self.call_stats: Dict[str, int] = {
+            "calls": 0,
+            "successes": 0,
+            "failures": 0,
+            "retries": 0,
+            "timeouts": 0,
+            "rejected": 0,
+        }
+        self._start_lock = asyncio.Lock()
+        # 每次（重新）连接递增，避免并发失败的调用重复重置同一个新连接
+        self.generation = 0
+        self.restarts = 0
+        self.in_flight = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def is_running(self) -> bool:
+        """连接是否处于可用状态"""
+        return (
+            self.session is not None
+            and self._runner is not None
+            and not self._runner.done()
+        )
+
+    async def ensure_started(self) -> None:
+        """按需启动服务器：首次使用、被空闲回收或崩溃重置后都会在此重新连接"""
+        if self.is_running:
+            return
+        async with self._start_lock:
+            if self.is_running:
+                return
+            logging.info(f"Starting server {self.name} on demand...")
+            if self.generation:
+                self.restarts += 1
+            async with asyncio.timeout(self.startup_timeout):
+                await self.initialize()
+
+    async def is_healthy(self) -> bool:
+        """通过 ping 检查服务器是否仍然可用"""
+        if not self.is_running:
+            return False
+        try:
+            async with asyncio.timeout(HEALTH_CHECK_TIMEOUT):
+                await self.session.send_ping()
+            return True
+        except Exception as e:
+            logging.warning(f"Health check failed for server {self.name}: {e!r}")
+            return False
+
+    async def reset(self, generation: Optional[int] = None) -> None:
+        """关闭（可能已损坏的）连接，下次使用时自动重启
+
+        Args:
+            generation: 仅当当前连接仍是该代时才重置
+        """
+        async with self._start_lock:
+            if generation is not None and generation != self.generation:
+                return
+            await self.cleanup()
+
+    async def stop_if_idle(self) -> bool:
+        """空闲超过 idle_timeout 且没有进行中的调用时关闭服务器进程"""
+        if not self.idle_timeout or not self.is_running:
+            return False
+        async with self._start_lock:
+            idle = time.monotonic() - self.last_used
+            if not self.is_running or self.in_flight or idle < self.idle_timeout:
+                return False
+            logging.info(f"Server {self.name} idle for {idle:.0f}s, stopping.")
+            await self.cleanup()
+        return True
+
+    def _connect(self) -> Any:
+        """按 "transport" 配置返回传输层的异步上下文管理器（产出读写流）"""
+        if self.transport == "stdio":
+            # command 字段直接从配置获取
+            command = self.config["command"]
+            if command is None:
+                raise ValueError("command 不能为空")
+
+            server_params = StdioServerParameters(
+                command=command,
+                args=self.config["args"],
+                env={**os.environ, **self.config["env"]}
+                if self.config.get("env")
+                else None,
+            )
+            return stdio_client(server_params)
+
+        url = self.config.get("url")
+        if not url:
+            raise ValueError(
+                f"Server {self.name} 使用 {self.transport} 传输时需配置 url"
+            )
+        timeout = self.config.get("http_timeout", DEFAULT_HTTP_TIMEOUT)
+        sse_read_timeout = self.config.get("sse_read_timeout", DEFAULT_SSE_READ_TIMEOUT)
+        # 每个连接使用一个带 keep-alive 连接池的 HTTP 客户端：同一会话上的并发
+        # 工具调用复用已建立的连接；额外的两个连接留给服务器推送用的 SSE 长连接
+        limits = httpx.Limits(
+            max_connections=self.max_concurrency + 2,
+            max_keepalive_connections=self.max_concurrency,
+        )
+
+        def http_client_factory(
+            headers: Optional[Dict[str, str]] = None,
+            timeout: Optional[httpx.Timeout] = None,
+            auth: Optional[httpx.Auth] = None,
+        ) -> httpx.AsyncClient:
+            return httpx.AsyncClient(
+                headers=headers,
+                timeout=timeout
+                or httpx.Timeout(DEFAULT_HTTP_TIMEOUT, read=DEFAULT_SSE_READ_TIMEOUT),
+                auth=auth,
+                limits=limits,
+            )
+
+        if self.transport == "sse":
+            return sse_client(
+                url,
+                headers=self.config.get("headers"),
+                timeout=timeout,
+                sse_read_timeout=sse_read_timeout,
+                httpx_client_factory=http_client_factory,
+            )
+        return streamablehttp_client(
+            url,
+            headers=self.config.get("headers"),
+            timeout=timeout,
+            sse_read_timeout=sse_read_timeout,
+            httpx_client_factory=http_client_factory,
+        )
+
+    async def initialize(self) -> None:
+        """初始化与 MCP 服务器的连接（stdio 子进程，或 HTTP / SSE 远程服务器）
+
+        传输层 / ClientSession 的上下文在独立的后台任务中进入和退出，
+        避免 anyio cancel scope 跨任务退出的问题，因此多个服务器可以并发初始化。
+        """
+        connect = self._connect()
+        started: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.generation += 1
+        self.last_used = time.monotonic()
+        self._stop_event.clear()
+        self._runner = asyncio.create_task(
+            self._run(connect, started), name=f"mcp-server-{self.name}"
+        )
+        try:
+            await started
+        except BaseException as e:
+            # 包括启动超时导致的取消
+            logging.error(f"Error initializing server {self.name}: {e!r}")
+            await self.cleanup()
+            raise
+
+    async def _run(self, connect: Any, started: asyncio.Future) -> None:
+        """持有服务器连接的后台任务，直到 cleanup() 发出停止信号"""
+        try:
+            async with AsyncExitStack() as stack:
+                # streamable HTTP 额外产出获取会话 ID 的回调，这里只需要读写流
+                streams = await stack.enter_async_context(connect)
+                read_stream, write_stream = streams[0], streams[1]
+                session = await stack.enter_async_context(
+                    ClientSession(read_stream, write_stream)
+                )
+                await session.initialize()
+                self.session = session
+                started.set_result(None)
+                await self._stop_event.wait()
+        except Exception as e:
+            if not started.done():
+                started.set_exception(e)
+            else:
+                logging.error(f"Server {self.name} connection closed: {e}")
+        finally:
+            self.session = None
+
+    async def list_tools(self) -> List[Any]:
+        """获取服务器可用的工具列表
+
+        Returns:
+            工具列表
+        """
+        request = {"server": self.name}
+        if cassette.replaying:
+            return [
+                Tool(t["name"], t["description"], t["input_schema"])
+                for t in await cassette.replay("list_tools", request)
+            ]
+        if not self.session:
+            raise RuntimeError(f"Server {self.name} not initialized")
+        start = time.perf_counter()
+        tools_response = await self.session.list_tools()
+        tools = []
+        for item in tools_response:
+            if isinstance(item, tuple) and item[0] == "tools":
+                for tool in item[1]:
+                    tools.append(Tool(tool.name, tool.description, tool.inputSchema))
+        if cassette.recording:
+            cassette.record(
+                "list_tools",
+                request,
+                time.perf_counter() - start,
+                response=[
+                    {
+                        "name": tool.name,
+                        "description": tool.description,
+                        "input_schema": tool.input_schema,
+                    }
+                    for tool in tools
+                ],
+            )
+        return tools
+
+    def timeout_for(self, tool_name: str) -> float:
+        """返回工具的调用截止时间（秒）"""
+        tool_config = self.config.get("tools", {}).get(tool_name, {})
+        return float(tool_config.get("timeout", self.call_timeout))
+
+    async def execute_tool(
+        self,
+        tool_name: str,
+        arguments: Dict[str, Any],
+        retries: Optional[int] = None,
+        delay: float = 1.0,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        """执行指定工具，支持截止时间、指数退避重试与熔断
+
+        同一服务器上的并发调用数受 max_concurrency 限制。服务器未运行时会先启动；
+        调用失败且 ping 不通时重置连接，下一次重试会重新启动服务器。
+        熔断期间直接抛出 CircuitOpenError。
+
+        Args:
+            tool_name: 工具名称
+            arguments: 工具参数
+            retries: 最多尝试次数，默认取服务器配置 "retries"
+            delay: 退避的基础秒数，第 n 次重试等待约 delay * 2^(n-1)（带随机抖动）
+            timeout: 单次尝试的截止时间，默认按工具配置
+
+        Returns:
+            工具调用结果
+        """
+        request = {"server": self.name, "tool": tool_name, "arguments": arguments}
+        if cassette.replaying:
+            return CallToolResult.model_validate(await cassette.replay("tool", request))
+        start = time.perf_counter()
+        try:
+            result = await self._execute_tool(
+                tool_name, arguments, retries, delay, timeout
+            )
+        except Exception as e:
+            if cassette.recording:
+                cassette.record("tool", request, time.perf_counter() - start, error=e)
+            raise
+        # 未录制时不序列化结果，关闭的功能不应给热路径增加开销
+        if cassette.recording:
+            cassette.record(
+                "tool",
+                request,
+                time.perf_counter() - start,
+                response=result.model_dump(mode="json", by_alias=True),
+            )
+        return result
+
+    async def _execute_tool(
+        self,
+        tool_name: str,
+        arguments: Dict[str, Any],
+        retries: Optional[int],
+        delay: float,
+        timeout: Optional[float],
+    ) -> Any:
+        """execute_tool 的实际执行部分（不经过录制 / 回放）"""
+        retries = self.retries if retries is None else retries
+        timeout = self.timeout_for(tool_name) if timeout is None else timeout
+        self.call_stats["calls"] += 1
+        self.in_flight += 1
+        try:
+            attempt = 0
+            while attempt < retries:
+                if not self.breaker.allow():
+                    self.call_stats["rejected"] += 1
+                    raise CircuitOpenError(self.name, self.breaker.retry_after())
+                generation = self.generation
+                try:
+                    await self.ensure_started()
+                    generation = self.generation
+                    # 截止时间包含排队等待并发名额的时间
+                    async with asyncio.timeout(timeout):
+                        async with self._call_semaphore:
+                            logging.info(
+                                f"Executing {tool_name} on server {self.name}..."
+                            )
+                            result = await self.session.call_tool(tool_name, arguments)
+                    self.breaker.record_success()
+                    self.call_stats["successes"] += 1
+                    return result
+                except asyncio.CancelledError:
+                    # 取消（预算超时、同组任务失败、客户端断开）不代表服务器故障，
+                    # 但半开状态下必须归还试探名额，否则熔断器永远停在 half_open
+                    self.breaker.release_trial()
+                    raise
+                except Exception as e:
+                    attempt += 1
+                    self.breaker.record_failure()
+                    if isinstance(e, TimeoutError):
+                        self.call_stats["timeouts"] += 1
+                        e = TimeoutError(f"{tool_name} 超过 {timeout}s 未返回")
+                    logging.warning(
+                        f"Error executing tool: {e}. Attempt {attempt} of {retries}."
+                    )
+                    if attempt < retries and self.breaker.state != "open":
+                        self.call_stats["retries"] += 1
+                        if not await self.is_healthy():
+                            logging.warning(
+                                f"Server {self.name} is unhealthy, restarting..."
+                            )
+                            await self.reset(generation)
+                        backoff = min(MAX_RETRY_DELAY, delay * 2 ** (attempt - 1))
+                        backoff = random.uniform(backoff / 2, backoff)
+                        logging.info(f"Retrying in {backoff:.2f} seconds...")
+                        await asyncio.sleep(backoff)
+                    else:
+                        logging.error("Max retries reached. Failing.")
+                        self.call_stats["failures"] += 1
+                        raise e
+        finally:
+            self.in_flight -= 1
+            self.last_used = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回调用、重试与熔断统计，用于监控"""
+        return {
+            **self.call_stats,
+            "breaker_state": self.breaker.state,
+            "breaker_trips": self.breaker.trips,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "restarts": self.restarts,
+            "running": self.is_running,
+            "in_flight": self.in_flight,
+        }
+
+    async def cleanup(self) -> None:
+        """清理服务器资源"""
+        async with self._cleanup_lock:
+            runner, self._runner = self._runner, None
+            if runner is None:
+                return
+            if self.session is None:
+                # 尚未完成握手（例如启动超时），直接取消后台任务
+                runner.cancel()
+            self._stop_event.set()
+            try:
+                await asyncio.wait_for(runner, timeout=SERVER_SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning(f"Server {self.name} did not stop in time, cancelled.")
+            except asyncio.CancelledError:
+                if not runner.cancelled():
+                    raise
+            except Exception as e:
+                logging.error(f"Error during cleanup of server {self.name}: {e}")
+            finally:
+                self.session = None
+
+
+# =============================
+# MCP 服务器监管类
+# =============================
+class ServerSupervisor:
+    """后台巡检所有服务器：回收空闲进程，并对运行中的服务器做健康检查
+
+    健康检查失败的服务器会被重置；非懒启动的服务器随即重新启动，
+    懒启动的服务器则在下次工具调用时再启动。
+    """
+
+    def __init__(self, servers: Dict[str, Server], interval: float = 10.0) -> None:
+        # 与 MultiServerMCPClient.servers 共享同一个字典
+        self.servers = servers
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="mcp-supervisor")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await asyncio.gather(
+                *(self._check(server) for server in list(self.servers.values())),
+                return_exceptions=True,
+            )
+
+    async def _check(self, server: Server) -> None:
+        if await server.stop_if_idle():
+            return
+        if not server.health_check or not server.is_running:
+            return
+        generation = server.generation
+        if await server.is_healthy():
+            return
+        logging.warning(f"Server {server.name} failed health check, restarting...")
+        await server.reset(generation)
+        if not server.lazy:
+            try:
+                await server.ensure_started()
+            except Exception as e:
+                logging.error(f"Failed to restart server {server.name}: {e!r}")
+
+
+# =============================
+# 工具封装类
+# =============================
+class Tool:
+    """封装 MCP 返回的工具信息"""
+
+    def __init__(
+        self, name: str, description: str, input_schema: Dict[str, Any]
+    ) -> None:
+        self.name: str = name
+        self.description: str = description
+        self.input_schema: Dict[str, Any] = input_schema
+
+    def format_for_llm(self) -> str:
+        """生成用于 LLM 提示的工具描述"""
+        args_desc = []
+        if "properties" in self.input_schema:
+            for param_name, param_info in self.input_schema["properties"].items():
+                arg_desc = (
+                    f"- {param_name}: {param_info.get('description', 'No description')}"
+                )
+                if param_name in self.input_schema.get("required", []):
+                    arg_desc += " (required)"
+                args_desc.append(arg_desc)
+        return f"""
+Tool: {self.name}
+Description: {self.description}
+Arguments:
+{chr(10).join(args_desc)}
+"""
+
+
+# =============================
+# 工具结果缓存类（TTL + LRU）
+# =============================
+class ToolResultCache:
+    """按 (服务器, 工具, 规范化参数) 缓存工具调用结果，支持 TTL 过期与 LRU 淘汰
+
+    是否缓存及 TTL 在 servers_config.json 中声明：服务器级 "cache_ttl" 作为默认值，
+    "tools" 下的同名工具配置可覆盖（"cache_ttl" 秒数，或 "cacheable": false 关闭）。
+    未声明 TTL 的工具不缓存，有副作用的工具（如 write_file）应显式关闭。
+    """
+
+    def __init__(self, max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        # key -> (过期时间, 结果)，按最近使用排序
+        self._entries: OrderedDict[Tuple[str, str, str], Tuple[float, str]] = (
+            OrderedDict()
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def ttl_for(srv_config: Dict[str, Any], tool_name: str) -> float:
+        """根据服务器配置返回工具结果的缓存秒数，0 表示不缓存"""
+        tool_config = srv_config.get("tools", {}).get(tool_name, {})
+        if not tool_config.get("cacheable", True):
+            return 0.0
+        return float(tool_config.get("cache_ttl", srv_config.get("cache_ttl", 0)))
+
+    @staticmethod
+    def make_key(
+        server_name: str, tool_name: str, arguments: Dict[str, Any]
+    ) -> Tuple[str, str, str]:
+        """参数按键排序后序列化，保证等价参数得到相同的键"""
+        canonical = json.dumps(
+            arguments, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+        )
+        return server_name, tool_name, canonical
+
+    def get(self, key: Tuple[str, str, str]) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, result = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key: Tuple[str, str, str], result: str, ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """返回命中/未命中等统计信息"""
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# =============================
+# 工具目录磁盘缓存类
+# =============================
+class ToolCatalogCache:
+    """将各服务器转换后的工具目录保存到磁盘，热启动时无需等待 list_tools
+
+    每个条目以服务器 command/args/env/transport/url 的哈希为指纹，配置变化后自动失效。
+    """
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self._catalog: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                self._catalog = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"无法读取工具目录缓存 {file_path}: {e}")
+
+    @staticmethod
+    def fingerprint(srv_config: Dict[str, Any]) -> str:
+        """计算服务器启动配置的哈希"""
+        key = {
+            field: srv_config.get(field)
+            for field in ("command", "args", "env", "transport", "url")
+        }
+        raw = json.dumps(key, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(
+        self, server_name: str, srv_config: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """返回与当前配置匹配的缓存条目 {"tools": [...], "functions": [...]}"""
+        entry = self._catalog.get(server_name)
+        if not entry or entry.get("fingerprint") != self.fingerprint(srv_config):
+            return None
+        return entry
+
+    def put(
+        self,
+        server_name: str,
+        srv_config: Dict[str, Any],
+        tools: List["Tool"],
+        functions: List[Dict[str, Any]],
+    ) -> None:
+        """更新某个服务器的工具目录并写回磁盘"""
+        self._catalog[server_name] = {
+            "fingerprint": self.fingerprint(srv_config),
+            "tools": [
+                {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "input_schema": tool.input_schema,
+                }
+                for tool in tools
+            ],
+            "functions": functions,
+        }
+        tmp_path = f"{self.file_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._catalog, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.file_path)
+        except OSError as e:
+            logging.warning(f"无法写入工具目录缓存 {self.file_path}: {e}")
+
+
+# =============================
+# 大型工具结果存储类（内容寻址）
+# =============================
+class ToolOutputStore:
+    """将大型工具结果与二进制内容按 sha256 转存到本地目录，相同内容只保存一份
+
+    文本以 <handle>.txt 保存，可通过内置工具 read_tool_output 分页读取；
+    图片、音频等二进制内容按 MIME 类型对应的扩展名保存，只向模型提供元信息。
+    目录总大小超过 max_bytes 或文件超过 max_age 秒未被使用时，按修改时间
+    从旧到新删除（重复写入或读取会刷新修改时间）。
+    """
+
+    # 转存后的预览中标识句柄的片段，用于判断上下文中是否有可分页读取的结果
+    SPILL_MARKER = "，已转存为 handle="
+    # 只按时间淘汰时，两次扫描目录的最小间隔（秒）
+    PRUNE_INTERVAL = 60.0
+
+    def __init__(
+        self,
+        directory: str,
+        inline_limit: int = 4000,
+        preview_chars: int = 800,
+        page_size: int = 4000,
+        max_bytes: int = 0,
+        max_age: float = 0.0,
+    ) -> None:
+        self.directory = directory
+        self.inline_limit = inline_limit
+        self.preview_chars = preview_chars
+        self.page_size = page_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # 目录当前的总字节数（首次写入时扫描得到）与上次扫描的时间
+        self._bytes: Optional[int] = None
+        self._pruned_at = 0.0
+
+    def _write(self, data: bytes, suffix: str) -> Tuple[str, str]:
+        """按内容哈希写入文件（已存在则只刷新修改时间），返回 (handle, 文件路径)"""
+        handle = hashlib.sha256(data).hexdigest()[:16]
+        path = os.path.join(self.directory, handle + suffix)
+        if os.path.exists(path):
+            self._touch(path)
+            return handle, path
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if self._bytes is not None:
+            self._bytes += len(data)
+        if self._prune_due():
+            self.prune()
+        return handle, path
+
+    @staticmethod
+    def _touch(path: str) -> None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _prune_due(self) -> bool:
+        if not self.max_bytes and not self.max_age:
+            return False
+        if self._bytes is None or (self.max_bytes and self._bytes > self.max_bytes):
+            return True
+        return bool(self.max_age) and (
+            time.time() - self._pruned_at > min(self.max_age, self.PRUNE_INTERVAL)
+        )
+
+    def prune(self) -> None:
+        """删除超过 max_age 的文件，并按修改时间从旧到新删除直到总大小不超过 max_bytes"""
+        now = time.time()
+        files: List[Tuple[float, int, str]] = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".tmp") or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError as e:
+            logging.warning(f"无法清理工具结果目录 {self.directory}: {e}")
+            return
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            expired = self.max_age and now - mtime > self.max_age
+            if not expired and (not self.max_bytes or total <= self.max_bytes):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning(f"无法删除工具结果 {path}: {e}")
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            logging.info(f"已清理 {removed} 个转存的工具结果，目录剩余 {total} 字节")
+        self._bytes = total
+        self._pruned_at = now
+
+    @classmethod
+    def spilled(cls, messages: List[Dict[str, Any]]) -> bool:
+        """messages 中是否有被转存、可分页读取的工具结果"""
+        return any(
+            message.get("role") == "tool"
+            and cls.SPILL_MARKER in str(message.get("content"))
+            for message in messages
+        )
+
+    def put_text(self, text: str) -> str:
+        return self._write(text.encode("utf-8"), ".txt")[0]
+
+    def put_blob(self, data: bytes, mime_type: Optional[str]) -> Tuple[str, str]:
+        suffix = mimetypes.guess_extension(mime_type or "") or ".bin"
+        return self._write(data, suffix)
+
+    def spill(self, text: str) -> str:
+        """文本超过 inline_limit 时转存，返回预览与句柄；否则原样返回"""
+        if not self.inline_limit or len(text) <= self.inline_limit:
+            return text
+        try:
+            handle = self.put_text(text)
+        except OSError as e:
+            logging.warning(f"无法转存工具结果: {e}")
+            return (
+                text[: self.inline_limit]
+                + f"\n…（结果过长，已截断，共 {len(text)} 字符）"
+            )
+        return (
+            f"[结果过长（共 {len(text)} 字符）{self.SPILL_MARKER}{handle}。"
+            f"以下为前 {self.preview_chars} 字符预览，如需更多内容请调用 "
+            f"{READ_OUTPUT_TOOL}(handle, offset) 分页读取]\n"
+            + text[: self.preview_chars]
+        )
+
+    def read(self, handle: str, offset: int = 0, limit: Optional[int] = None) -> str:
+        """分页读取已转存的文本结果，返回 JSON 字符串"""
+        if not re.fullmatch(r"[0-9a-f]{16}", handle):
+            raise ValueError(f"无效的 handle: {handle}")
+        path = os.path.join(self.directory, handle + ".txt")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            raise ValueError(
+                f"找不到 handle={handle} 对应的文本结果（可能已过期被清理）"
+            ) from None
+        self._touch(path)
+        limit = min(limit or self.page_size, self.page_size)
+        offset = max(offset, 0)
+        end = min(offset + limit, len(text))
+        return json.dumps(
+            {
+                "handle": handle,
+                "offset": offset,
+                "total": len(text),
+                "next_offset": end if end < len(text) else None,
+                "content": text[offset:end],
+            },
+            ensure_ascii=False,
+        )
+
+    def function(self) -> Dict[str, Any]:
+        """内置分页读取工具的 OpenAI 函数定义"""
+        return {
+            "type": "function",
+            "function": {
+                "name": READ_OUTPUT_TOOL,
+                "description": "分页读取此前因过长而被转存的工具结果。",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "handle": {
+                            "type": "string",
+                            "description": "工具结果预览中给出的 handle",
+                        },
+                        "offset": {
+                            "type": "integer",
+                            "description": "起始字符位置，默认 0；"
+                            "上一页返回的 next_offset 即下一页的起点",
+                        },
+                        "limit": {
+                            "type": "integer",
+                            "description": f"本页最多读取的字符数，"
+                            f"不超过 {self.page_size}",
+                        },
+                    },
+                    "required": ["handle"],
+                },
+            },
+        }
+
+
+# =============================
+# 工具检索索引类
+# =============================
+def tokenize(text: str) -> List[str]:
+    """分词：英文/数字按单词切分（含 snake_case 拆分），中文按相邻二字切分"""
+    text = text.lower()
+    tokens = re.findall(r"[a-z0-9]+", text)
+    for run in re.findall(r"[\u4e00-\u9fff]+", text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class ToolIndex:
+    """基于 BM25 的本地工具检索索引，对工具名、描述与参数说明建索引"""
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, functions: List[Dict[str, Any]]) -> None:
+        self.names: List[str] = []
+        self._term_freqs: List[Counter] = []
+        self._doc_lens: List[int] = []
+        doc_freq: Counter = Counter()
+        for item in functions:
+            function = item["function"]
+            parts = [function["name"], function.get("description") or ""]
+            for name, prop in (
+                function.get("parameters", {}).get("properties", {}).items()
+            ):
+                parts.extend([name, str(prop.get("description", ""))])
+            terms = Counter(tokenize(" ".join(parts)))
+            self.names.append(function["name"])
+            self._term_freqs.append(terms)
+            self._doc_lens.append(sum(terms.values()))
+            doc_freq.update(terms.keys())
+        n = len(self.names)
+        self._avg_len = (sum(self._doc_lens) / n) if n else 0.0
+        self._idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in doc_freq.items()
+        }
+
+    def search(self, query: str, top_k: int) -> List[str]:
+        """返回与查询最相关的至多 top_k 个工具名（只包含得分大于 0 的工具）"""
+        query_terms = set(tokenize(query))
+        scored = []
+        for i, terms in enumerate(self._term_freqs):
+            score = 0.0
+            norm = self.K1 * (1 - self.B + self.B * self._doc_lens[i] / self._avg_len)
+            for term in query_terms:
+                tf = terms.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (self.K1 + 1) / (tf + norm)
+            if score > 0:
+                scored.append((score, -i))
+        scored.sort(reverse=True)
+        return [self.names[-i] for _, i in scored[:top_k]]
+
+
+# =============================
+# LLM 客户端封装类（使用 OpenAI SDK）
+# =============================
+class LLMClient:
+    """使用 OpenAI SDK（异步）与大模型交互，所有请求共享同一个 HTTP 连接池"""
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: Optional[str],
+        model: str,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 60.0,
+        timeout: float = 120.0,
+        connect_timeout: float = 10.0,
+    ) -> None:
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
+        self.client = AsyncOpenAI(
+            api_key=api_key, base_url=base_url, http_client=self.http_client
+        )
+        self.model = model
+
+    @classmethod
+    def from_config(cls, config: Configuration) -> "LLMClient":
+        """根据 Configuration 中的模型及连接池配置创建客户端"""
+        return cls(
+            config.api_key,
+            config.base_url,
+            config.model,
+            max_connections=config.llm_max_connections,
+            max_keepalive_connections=config.llm_max_keepalive,
+            keepalive_expiry=config.llm_keepalive_expiry,
+            timeout=config.llm_timeout,
+            connect_timeout=config.llm_connect_timeout,
+        )
+
+    async def get_response(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]] = None,
+        tool_choice: Optional[str] = None,
+    ) -> Any:
+        """
+        发送消息给大模型 API，支持传入工具参数（function calling 格式）
+        """
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "tools": tools,
+        }
+        if tools and tool_choice:
+            payload["tool_choice"] = tool_choice
+        with tracer.span("llm", model=self.model) as span:
+            if cassette.replaying:
+                response = ChatCompletion.model_validate(
+                    await cassette.replay("llm", payload)
+                )
+            else:
+                start = time.perf_counter()
+                try:
+                    response = await self.client.chat.completions.create(**payload)
+                except Exception as e:
+                    logging.error(f"Error during LLM call: {e}")
+                    if cassette.recording:
+                        cassette.record(
+                            "llm", payload, time.perf_counter() - start, error=e
+                        )
+                    raise
+                if cassette.recording:
+                    cassette.record(
+                        "llm",
+                        payload,
+                        time.perf_counter() - start,
+                        response=response.model_dump(mode="json"),
+                    )
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                span.set(
+                    prompt_tokens=usage.prompt_tokens,
+                    completion_tokens=usage.completion_tokens,
+                )
+            return response
+
+    async def stream_response(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]] = None,
+        tool_choice: Optional[str] = None,
+    ) -> Any:
+        """
+        以流式方式发送消息，返回可异步迭代的 ChatCompletionChunk 流
+        """
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "tools": tools,
+            "stream": True,
+        }
+        if tools and tool_choice:
+            payload["tool_choice"] = tool_choice
+        if cassette.replaying:
+            # 先取出录制的分片，未录制的请求在此处立即报错
+            chunks = await cassette.replay("llm_stream", payload)
+            return cassette.replay_stream(chunks)
+        start = time.perf_counter()
+        try:
+            stream = await self.client.chat.completions.create(**payload)
+        except Exception as e:
+            logging.error(f"Error during LLM stream call: {e}")
+            if cassette.recording:
+                cassette.record(
+                    "llm_stream", payload, time.perf_counter() - start, error=e
+                )
+            raise
+        if cassette.recording:
+            return cassette.record_stream(stream, "llm_stream", payload, start)
+        return stream
+
+    async def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        """调用 embeddings 接口计算文本向量"""
+        with tracer.span("embedding", model=model):
+            response = await self.client.embeddings.create(model=model, input=texts)
+        return [item.embedding for item in response.data]
+
+    async def close(self) -> None:
+        """关闭底层 HTTP 连接池"""
+        await self.client.close()
+
+
+# =============================
+# 跨会话公平调度类
+# =============================
+class FairScheduler:
+    """在全局并发上限内按会话轮转放行工具调用
+
+    每个会话有自己的等待队列，空出名额时依次从各会话队首取一个调用，
+    避免某个会话一次发出大量工具调用时饿死其它会话。
+    """
+
+    def __init__(self, max_concurrency: int = 16, max_queue: int = 256) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self._queues: OrderedDict[str, Deque[asyncio.Future]] = OrderedDict()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def saturated(self) -> bool:
+        """等待队列已满，应拒绝新的请求（准入控制）"""
+        return self.waiting >= self.max_queue
+
+    @asynccontextmanager
+    async def slot(self, key: str) -> AsyncIterator[None]:
+        """为会话 key 申请一个执行名额"""
+        await self._acquire(key)
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._dispatch()
+
+    async def _acquire(self, key: str) -> None:
+        if self.active < self.max_concurrency and not self._queues:
+            self.active += 1
+            return
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.cancel():
+                # 名额已分配但调用方被取消，归还名额
+                self.active -= 1
+                self._dispatch()
+            raise
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_concurrency and self._queues:
+            key, queue = self._queues.popitem(last=False)
+            future = queue.popleft()
+            if queue:
+                # 该会话还有等待的调用，排到队尾等待下一轮
+                self._queues[key] = queue
+            if future.cancelled():
+                continue
+            future.set_result(None)
+            self.active += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "sessions_waiting": len(self._queues),
+        }
+
+
+# =============================
+# 对话上下文窗口管理类（token 预算 + 后台摘要）
+# =============================
+@lru_cache(maxsize=1)
+def _get_encoding() -> Any:
+    """加载并缓存 tokenizer，tiktoken 不可用时返回 None"""
+    if tiktoken is None:
+        logging.warning(
+            "未安装 tiktoken，token 数按字符估算，CONTEXT_MAX_TOKENS 只是近似值"
+        )
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logging.warning(
+            f"无法加载 tokenizer，token 数按字符估算，CONTEXT_MAX_TOKENS 只是近似值: {e}"
+        )
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_text_tokens(text: str) -> int:
+    """计算文本的 token 数（结果按文本缓存）"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # 估算：中日韩字符约 1 token/字，其余约 4 字符/token
+    cjk = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(message: Dict[str, Any]) -> int:
+    """计算单条消息的 token 数（含每条消息的固定开销）"""
+    tokens = 4
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += count_text_tokens(content)
+    elif content:
+        tokens += count_text_tokens(json.dumps(content, ensure_ascii=False))
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        tokens += count_text_tokens(function.get("name", ""))
+        tokens += count_text_tokens(function.get("arguments", ""))
+    return tokens
+
+
+class ContextWindowManager:
+    """按 token 预算维护对话历史
+
+    历史按"轮"分组：一轮从 user 消息开始，包含其后的 assistant（含 tool_calls）
+    与 tool 消息，淘汰时整轮移除，不会拆开 tool_calls 与对应的 tool 回复。
+    被淘汰的轮次交给后台任务调用大模型生成摘要，摘要以 system 消息放在上下文开头。
+    """
+
+    SUMMARY_PROMPT = (
+        "请将以下对话历史压缩为简洁的中文摘要，保留用户的关键信息、偏好、"
+        "已得到的结论与工具结果中的重要数据，不要编造内容。"
+    )
+
+    def __init__(
+        self,
+        llm_client: Optional["LLMClient"] = None,
+        max_tokens: int = 8000,
+    ) -> None:
+        self.llm_client = llm_client
+        self.max_tokens = max_tokens
+        self.groups: List[List[Dict[str, Any]]] = []
+        self.summary: str = ""
+        self._evicted: List[List[Dict[str, Any]]] = []
+        self._summary_task: Optional[asyncio.Task] = None
+        # 最近使用过的工具（按使用先后排序），用于工具子集选择时保持"粘性"
+        self.recent_tools: OrderedDict[str, None] = OrderedDict()
+        # 启动时即加载 tokenizer（结果有缓存），不可用时只在此处告警一次
+        _get_encoding()
+
+    def note_tools(self, messages: List[Dict[str, Any]], limit: int) -> None:
+        """记录消息中 assistant 调用过的工具，只保留最近的 limit 个"""
+        for message in messages:
+            for tool_call in message.get("tool_calls") or []:
+                name = tool_call["function"]["name"]
+                self.recent_tools[name] = None
+                self.recent_tools.move_to_end(name)
+        while len(self.recent_tools) > max(limit, 0):
+            self.recent_tools.popitem(last=False)
+
+    def add(self, messages: List[Dict[str, Any]]) -> None:
+        """追加消息，user 消息开启新的一轮"""
+        for message in messages:
+            if message.get("role") == "user" or not self.groups:
+                self.groups.append([])
+            self.groups[-1].append(message)
+
+    def prompt(self) -> List[Dict[str, Any]]:
+        """按预算淘汰旧轮次后返回本次请求使用的消息列表（新列表）"""
+        self._fit()
+        messages: List[Dict[str, Any]] = []
+        if self.summary:
+            messages.append(self._summary_message())
+        for group in self.groups:
+            messages.extend(group)
+        return messages
+
+    def token_count(self) -> int:
+        """当前上下文（含摘要）的 token 数"""
+        total = sum(count_message_tokens(m) for g in self.groups for m in g)
+        if self.summary:
+            total += count_message_tokens(self._summary_message())
+        return total
+
+    def _summary_message(self) -> Dict[str, Any]:
+        return {"role": "system", "content": f"此前对话的摘要：\n{self.summary}"}
+
+    def _fit(self) -> None:
+        evicted = []
+        # 始终保留最新一轮
+        while len(self.groups) > 1 and self.token_count() > self.max_tokens:
+            evicted.append(self.groups.pop(0))
+        if not evicted:
+            return
+        logging.info(f"上下文超出 {self.max_tokens} tokens，已移出 {len(evicted)} 轮")
+        if self.llm_client is None:
+            return
+        self._evicted.extend(evicted)
+        if self._summary_task is None or self._summary_task.done():
+            self._summary_task = asyncio.create_task(self._summarize())
+
+    async def _summarize(self) -> None:
+        """后台将已淘汰的轮次合并进摘要，不阻塞当前请求"""
+        while self._evicted:
+            evicted, self._evicted = self._evicted, []
+            lines = [f"已有摘要：{self.summary}"] if self.summary else []
+            for group in evicted:
+                for message in group:
+                    if message.get("content"):
+                        lines.append(f"{message['role']}: {message['content']}")
+            try:
+                response = await self.llm_client.get_response(
+                    [
+                        {"role": "system", "content": self.SUMMARY_PROMPT},
+                        {"role": "user", "content": "\n".join(lines)},
+                    ]
+                )
+                self.summary = response.choices[0].message.content or self.summary
+            except Exception as e:
+                logging.warning(f"对话摘要生成失败，保留原摘要: {e}")
+
+    async def aclose(self) -> None:
+        """取消尚未完成的摘要任务"""
+        if self._summary_task and not self._summary_task.done():
+            self._summary_task.cancel()
+            await asyncio.gather(self._summary_task, return_exceptions=True)
 
 
 # =============================
-# MCP 服务器客户端类
+# 回答缓存类（精确 + 语义匹配）
 # =============================
-class Server:
-    """管理单个 MCP 服务器连接和工具调用"""
+def normalize_query(query: str) -> str:
+    """
+    精确匹配使用的键：只统一全半角、大小写与空白。
+    运算符、标点与疑问词都保留，"2+2" 与 "2-2"、"what are you" 与 "how are you"
+    是不同的问题
+    """
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
 
-    def __init__(self, name: str, config: Dict[str, Any]) -> None:
-        self.name: str = name
-        self.config: Dict[str, Any] = config
-        self.session: Optional[ClientSession] = None
-        self.exit_stack: AsyncExitStack = AsyncExitStack()
-        self._cleanup_lock = asyncio.Lock()
 
-    async def initialize(self) -> None:
-        """初始化与 MCP 服务器的连接"""
-        # command 字段直接从配置获取
-        command = self.config["command"]
-        if command is None:
-            raise ValueError("command 不能为空")
-
-        server_params = StdioServerParameters(
-            command=command,
-            args=self.config["args"],
-            env={**os.environ, **self.config["env"]}
-            if self.config.get("env")
-            else None,
-        )
-        try:
-            stdio_transport = await self.exit_stack.enter_async_context(
-                stdio_client(server_params)
-            )
-            read_stream, write_stream = stdio_transport
-            session = await self.exit_stack.enter_async_context(
-                ClientSession(read_stream, write_stream)
-            )
-            await session.initialize()
-            self.session = session
-        except Exception as e:
-            logging.error(f"Error initializing server {self.name}: {e}")
-            await self.cleanup()
-            raise
+# 问题中的实体：(数字序列, 英文大写开头的单词, 规范化后的中文字符)
+QueryEntities = Tuple[Tuple[str, ...], FrozenSet[str], str]
 
-    async def list_tools(self) -> List[Any]:
-        """获取服务器可用的工具列表
 
-        Returns:
-            工具列表
-        """
-        if not self.session:
-            raise RuntimeError(f"Server {self.name} not initialized")
-        tools_response = await self.session.list_tools()
-        tools = []
-        for item in tools_response:
-            if isinstance(item, tuple) and item[0] == "tools":
-                for tool in item[1]:
-                    tools.append(Tool(tool.name, tool.description, tool.inputSchema))
-        return tools
+def query_entities(query: str) -> QueryEntities:
+    """提取语义匹配时必须一致的部分：数字、英文专有名词与中文内容"""
+    text = unicodedata.normalize("NFKC", query)
+    numbers = tuple(re.findall(r"\d+(?:\.\d+)?", text))
+    names = frozenset(re.findall(r"\b[A-Z][A-Za-z'-]*", text))
+    cjk = "".join(re.findall(r"[\u4e00-\u9fff]+", normalize_query(query)))
+    return numbers, names, cjk
 
-    async def execute_tool(
-        self,
-        tool_name: str,
-        arguments: Dict[str, Any],
-        retries: int = 2,
-        delay: float = 1.0,
-    ) -> Any:
-        """执行指定工具，并支持重试机制
 
-        Args:
-            tool_name: 工具名称
-            arguments: 工具参数
-            retries: 重试次数
-            delay: 重试间隔秒数
+def _has_new_word(text: str, other: str) -> bool:
+    """text 中是否有两个相邻汉字都不出现在 other 中（视为不同的地名、人名等词语）"""
+    chars = set(other)
+    return any(
+        text[i] not in chars and text[i + 1] not in chars for i in range(len(text) - 1)
+    )
 
-        Returns:
-            工具调用结果
-        """
-        if not self.session:
-            raise RuntimeError(f"Server {self.name} not initialized")
-        attempt = 0
-        while attempt < retries:
-            try:
-                logging.info(f"Executing {tool_name} on server {self.name}...")
-                result = await self.session.call_tool(tool_name, arguments)
-                return result
-            except Exception as e:
-                attempt += 1
-                logging.warning(
-                    f"Error executing tool: {e}. Attempt {attempt} of {retries}."
-                )
-                if attempt < retries:
-                    logging.info(f"Retrying in {delay} seconds...")
-                    await asyncio.sleep(delay)
-                else:
-                    logging.error("Max retries reached. Failing.")
-                    raise
 
-    async def cleanup(self) -> None:
-        """清理服务器资源"""
-        async with self._cleanup_lock:
-            try:
-                await self.exit_stack.aclose()
-                self.session = None
-            except Exception as e:
-                logging.error(f"Error during cleanup of server {self.name}: {e}")
+def same_entities(a: QueryEntities, b: QueryEntities) -> bool:
+    """两个问题的数字、英文专有名词一致，且中文部分没有对方缺少的词语"""
+    return (
+        a[0] == b[0]
+        and a[1] == b[1]
+        and not _has_new_word(a[2], b[2])
+        and not _has_new_word(b[2], a[2])
+    )
 
 
-# =============================
-# 工具封装类
-# =============================
-class Tool:
-    """封装 MCP 返回的工具信息"""
+class AnswerCache:
+    """缓存无上下文问题的最终回答，命中时无需调用大模型与工具
+
+    先按规范化后的问题精确匹配（空问题不查询也不写入）；配置了 embeddings 函数时，再按向量余弦相似度
+    （不低于 threshold）匹配，且两个问题的数字与专有名词必须一致
+    （"北京" 与 "上海"、"789" 与 "788" 的问题不会互相命中）。
+    每条回答的 TTL 取决于生成它时调用过的工具（见 MultiServerMCPClient._answer_ttl），
+    条目数超过 max_entries 时按 LRU 淘汰。命中、未命中、写入与淘汰计入指标
+    mcp_answer_cache_total。
+    """
 
     def __init__(
-        self, name: str, description: str, input_schema: Dict[str, Any]
+        self,
+        max_entries: int = 512,
+        threshold: float = 0.9,
+        default_ttl: float = 600.0,
+        embed: Optional[Callable[[List[str]], Any]] = None,
+        toolless_ttl: float = 0.0,
     ) -> None:
-        self.name: str = name
-        self.description: str = description
-        self.input_schema: Dict[str, Any] = input_schema
+        self.max_entries = max_entries
+        self.threshold = threshold
+        # 调用过工具的回答的 TTL 上限，以及没有调用工具的回答的 TTL
+        self.default_ttl = default_ttl
+        self.toolless_ttl = toolless_ttl
+        # 远程 embeddings 接口（异步，批量），为 None 时只做精确匹配
+        self._embed = embed
+        # 规范化问题 -> (过期时间, 单位向量, 问题实体, 回答)，按最近使用排序
+        self._entries: OrderedDict[
+            str, Tuple[float, Optional[List[float]], QueryEntities, str]
+        ] = OrderedDict()
+        self.counts: Counter = Counter()
 
-    def format_for_llm(self) -> str:
-        """生成用于 LLM 提示的工具描述"""
-        args_desc = []
-        if "properties" in self.input_schema:
-            for param_name, param_info in self.input_schema["properties"].items():
-                arg_desc = (
-                    f"- {param_name}: {param_info.get('description', 'No description')}"
-                )
-                if param_name in self.input_schema.get("required", []):
-                    arg_desc += " (required)"
-                args_desc.append(arg_desc)
-        return f"""
-Tool: {self.name}
-Description: {self.description}
-Arguments:
-{chr(10).join(args_desc)}
-"""
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _count(self, result: str) -> None:
+        self.counts[result] += 1
+        if tracer.enabled:
+            tracer.metrics.inc("mcp_answer_cache_total", result=result)
+
+    @property
+    def semantic(self) -> bool:
+        return self._embed is not None
+
+    async def _vector(self, key: str) -> List[float]:
+        vector = (await self._embed([key]))[0]
+        norm = math.sqrt(math.sumprod(vector, vector)) or 1.0
+        return [v / norm for v in vector]
+
+    async def lookup(self, query: str) -> Tuple[Optional[str], Optional[List[float]]]:
+        """返回 (命中的回答或 None, 问题向量)；向量在写入时复用，避免重复计算。
+        未配置 embeddings 函数时向量为 None"""
+        start = time.perf_counter()
+        key = normalize_query(query)
+        if not key:
+            self._count("miss")
+            return None, None
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self._count("exact_hit")
+                tracer.annotate(answer_cache="exact_hit")
+                return entry[3], entry[1]
+            del self._entries[key]
+            self._count("expired")
+        if not self.semantic:
+            self._count("miss")
+            return None, None
+        try:
+            vector = await self._vector(key)
+        except Exception as e:
+            # 缓存只是优化，embeddings 接口出错时按未命中处理，不影响本轮对话
+            logging.warning(f"回答缓存计算向量失败，按未命中处理: {e!r}")
+            self._count("error")
+            self._count("miss")
+            return None, None
+        entities = query_entities(query)
+        best_key, best_score = None, self.threshold
+        for other, (expires_at, other_vector, other_entities, _) in list(
+            self._entries.items()
+        ):
+            if expires_at <= now:
+                del self._entries[other]
+                self._count("expired")
+                continue
+            if other_vector is None:
+                continue
+            score = math.sumprod(vector, other_vector)
+            if score >= best_score and same_entities(entities, other_entities):
+                best_key, best_score = other, score
+        if tracer.enabled:
+            tracer.metrics.observe(
+                "mcp_answer_cache_lookup_seconds", time.perf_counter() - start
+            )
+        if best_key is None:
+            self._count("miss")
+            return None, vector
+        self._entries.move_to_end(best_key)
+        self._count("semantic_hit")
+        tracer.annotate(answer_cache="semantic_hit", similarity=round(best_score, 4))
+        return self._entries[best_key][3], vector
+
+    def store(
+        self, query: str, vector: Optional[List[float]], answer: str, ttl: float
+    ) -> None:
+        """写入回答；ttl 不大于 0 或问题为空时不缓存"""
+        key = normalize_query(query)
+        if ttl <= 0 or not answer or not key:
+            self._count("skipped")
+            return
+        self._entries[key] = (
+            time.monotonic() + ttl,
+            vector,
+            query_entities(query),
+            answer,
+        )
+        self._entries.move_to_end(key)
+        self._count("stored")
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._count("evicted")
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._entries), **self.counts}
 
 
 # =============================
-# LLM 客户端封装类（使用 OpenAI SDK）
+# 单轮对话预算类
 # =============================
-class LLMClient:
-    """使用 OpenAI SDK 与大模型交互"""
+class TurnBudget:
+    """单轮对话的预算：工具调用轮数、累计 token 数与墙钟时间（0 表示不限制）"""
 
-    def __init__(self, api_key: str, base_url: Optional[str], model: str) -> None:
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
-        self.model = model
+    def __init__(
+        self, max_rounds: int = 8, max_tokens: int = 0, timeout: float = 0.0
+    ) -> None:
+        self.max_rounds = max_rounds
+        self.max_tokens = max_tokens
+        self.deadline: Optional[float] = (
+            asyncio.get_running_loop().time() + timeout if timeout > 0 else None
+        )
+        self.tool_rounds = 0
+        self.tokens = 0
+        self.timed_out = False
 
-    def get_response(
-        self,
-        messages: List[Dict[str, Any]],
-        tools: Optional[List[Dict[str, Any]]] = None,
-    ) -> Any:
+    def charge_response(self, response: Any) -> None:
+        """按响应中的 usage 累计 token 数"""
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.tokens += usage.total_tokens
+
+    def exhausted(self) -> Optional[str]:
+        """返回已耗尽的预算名称，未耗尽时返回 None"""
+        if self.timed_out or (
+            self.deadline is not None
+            and asyncio.get_running_loop().time() >= self.deadline
+        ):
+            return "时间"
+        if self.max_rounds and self.tool_rounds >= self.max_rounds:
+            return "工具调用轮数"
+        if self.max_tokens and self.tokens >= self.max_tokens:
+            return "token"
+        return None
+
+    @asynccontextmanager
+    async def guard(self) -> AsyncIterator[None]:
         """
-        发送消息给大模型 API，支持传入工具参数（function calling 格式）
+        在剩余时间内执行代码块；到达截止时间时取消其中尚未完成的操作
+        （包括正在进行的工具调用），标记 timed_out 后正常返回而不抛出异常
         """
-        payload = {
-            "model": self.model,
-            "messages": messages,
-            "tools": tools,
-        }
         try:
-            response = self.client.chat.completions.create(**payload)
-            return response
-        except Exception as e:
-            logging.error(f"Error during LLM call: {e}")
-            raise
+            async with asyncio.timeout_at(self.deadline) as scope:
+                yield
+        except TimeoutError:
+            if not scope.expired():
+                raise
+            self.timed_out = True
 
 
 # =============================
 # 多服务器 MCP 客户端类（集成配置文件、工具格式转换与 OpenAI SDK 调用）
 # =============================
 class MultiServerMCPClient:
-    def __init__(self) -> None:
+    def __init__(self, llm_client: Optional[LLMClient] = None) -> None:
         """
         管理多个 MCP 服务器，并使用 OpenAI Function Calling 风格的接口调用大模型
+
+        Args:
+            llm_client: 可选的共享 LLMClient（复用其连接池）；不传则按配置新建
         """
         self.exit_stack = AsyncExitStack()
         config = Configuration()
         self.openai_api_key = config.api_key
         self.base_url = config.base_url
         self.model = config.model
-        self.client = LLMClient(self.openai_api_key, self.base_url, self.model)
+        self.context_max_tokens = config.context_max_tokens
+        self.tool_top_k = config.tool_top_k
+        self.tool_sticky = config.tool_sticky
+        self.turn_max_rounds = config.turn_max_rounds
+        self.turn_max_tokens = config.turn_max_tokens
+        self.turn_timeout = config.turn_timeout
+        self.turn_final_timeout = config.turn_final_timeout
+        if config.trace_file or config.metrics_enabled:
+            tracer.configure(config.trace_file, config.metrics_enabled)
+        if config.cassette_file and cassette.mode is None:
+            cassette.configure(
+                config.cassette_file, config.cassette_mode, config.cassette_timing
+            )
+        self._owns_client = llm_client is None
+        self.client = llm_client or LLMClient.from_config(config)
+        # 多会话服务模式下设置，用于跨会话公平调度工具调用
+        self.tool_scheduler: Optional[FairScheduler] = None
+        self.tool_cache = ToolResultCache(config.tool_cache_max_entries)
+        self.catalog_cache: Optional[ToolCatalogCache] = (
+            ToolCatalogCache(config.tool_catalog_cache)
+            if config.tool_catalog_cache
+            else None
+        )
         # (server_name -> Server 对象)
         self.servers: Dict[str, Server] = {}
+        self.supervisor = ServerSupervisor(self.servers, config.supervisor_interval)
         # 各个 server 的工具列表
         self.tools_by_server: Dict[str, List[Any]] = {}
+        # 启动失败的服务器 (server_name -> 错误信息)
+        self.failed_servers: Dict[str, str] = {}
+        # 各个 server 转换后的 OpenAI 函数列表，按配置顺序拼接为 all_tools
+        self._functions_by_server: Dict[str, List[Dict[str, Any]]] = {}
+        self._server_order: List[str] = []
+        # 正在后台连接的服务器 (server_name -> 连接任务)
+        self._pending_servers: Dict[str, asyncio.Task] = {}
         self.all_tools: List[Dict[str, Any]] = []
+        self.answer_cache = AnswerCache(
+            config.answer_cache_max_entries,
+            config.answer_cache_threshold,
+            config.answer_cache_ttl,
+            self._embedder(config.embedding_model),
+            config.answer_cache_toolless_ttl,
+        )
+        # 大型工具结果与非文本内容的本地存储
+        self.output_store = ToolOutputStore(
+            config.tool_output_dir,
+            config.tool_output_inline_limit,
+            config.tool_output_preview,
+            config.tool_output_page_size,
+            config.tool_output_max_bytes,
+            config.tool_output_max_age,
+        )
+        # 函数名 -> (server_name, tool_name) 的精确路由表，以及工具检索索引
+        self._tool_routes: Dict[str, Tuple[str, str]] = {}
+        self._tool_index = ToolIndex([])
 
     async def connect_to_servers(self, servers_config: Dict[str, Any]) -> None:
         """
         根据配置文件同时启动多个服务器并获取工具
+        每个服务器的启动受 "startup_timeout"（秒）限制，启动失败的服务器记录在
+        self.failed_servers 中，其余服务器照常使用。
         servers_config 的格式为：
         {
           "mcpServers": {
@@ -248,43 +2143,225 @@ class MultiServerMCPClient:
         }
         """
         mcp_servers = servers_config.get("mcpServers", {})
+        self._server_order = list(mcp_servers)
+        # 所有服务器并发启动，单个服务器失败或超时不影响其它服务器
         for server_name, srv_config in mcp_servers.items():
-            server = Server(server_name, srv_config)
-            await server.initialize()
-            self.servers[server_name] = server
-            tools = await server.list_tools()
-            self.tools_by_server[server_name] = tools
-
-            for tool in tools:
-                # 统一重命名：serverName_toolName
-                function_name = f"{server_name}_{tool.name}"
-                self.all_tools.append(
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": function_name,
-                            "description": tool.description,
-                            "input_schema": tool.input_schema,
-                        },
-                    }
-                )
+            cached = (
+                self.catalog_cache.get(server_name, srv_config)
+                if self.catalog_cache
+                else None
+            )
+            if cached is not None:
+                # 热启动：先使用磁盘缓存的工具目录，服务器在后台继续连接
+                self.tools_by_server[server_name] = [
+                    Tool(t["name"], t["description"], t["input_schema"])
+                    for t in cached["tools"]
+                ]
+                self._functions_by_server[server_name] = cached["functions"]
+                if srv_config.get("lazy"):
+                    # 懒启动：首次调用工具时才启动进程
+                    self.servers[server_name] = Server(server_name, srv_config)
+                    continue
+            self._pending_servers[server_name] = asyncio.create_task(
+                self._connect_server(server_name, srv_config, cached)
+            )
+        self._rebuild_all_tools()
+        # 只等待没有缓存目录的服务器
+        await asyncio.gather(
+            *(
+                task
+                for server_name, task in self._pending_servers.items()
+                if server_name not in self._functions_by_server
+            )
+        )
 
-        # 转换为 OpenAI Function Calling 所需格式
-        self.all_tools = await self.transform_json(self.all_tools)
+        self.supervisor.start()
 
         logging.info("\n✅ 已连接到下列服务器:")
         for name in self.servers:
             srv_cfg = mcp_servers[name]
+            lazy = "" if self.servers[name].is_running else "（懒启动，未运行）"
+            if "url" in srv_cfg:
+                target = f"{srv_cfg.get('transport')}={srv_cfg['url']}"
+            else:
+                target = f"command={srv_cfg['command']}, args={srv_cfg['args']}"
+            logging.info(f"  - {name}: {target}{lazy}")
+        if self._pending_servers:
             logging.info(
-                f"  - {name}: command={srv_cfg['command']}, args={srv_cfg['args']}"
+                f"\n⏳ 使用缓存的工具目录，后台连接中: {list(self._pending_servers)}"
             )
+        if self.failed_servers:
+            logging.warning("\n⚠️ 以下服务器启动失败，已跳过:")
+            for name, error in self.failed_servers.items():
+                logging.warning(f"  - {name}: {error}")
         logging.info("\n汇总的工具:")
         for t in self.all_tools:
             logging.info(f"  - {t['function']['name']}")
 
-    async def transform_json(
-        self, json_data: List[Dict[str, Any]]
+    async def wait_for_servers(self) -> None:
+        """等待所有后台连接中的服务器完成启动（成功或失败）"""
+        await asyncio.gather(*list(self._pending_servers.values()))
+
+    async def _connect_server(
+        self,
+        server_name: str,
+        srv_config: Dict[str, Any],
+        cached: Optional[Dict[str, Any]],
+    ) -> None:
+        """
+        启动单个服务器并登记其工具；若之前使用了缓存目录，则与实时目录比对并更新
+        """
+        try:
+            server, tools = await self._start_server(server_name, srv_config)
+        except Exception as e:
+            self.failed_servers[server_name] = str(e) or repr(e)
+            if cached is not None:
+                logging.warning(f"服务器 {server_name} 启动失败，移除其缓存工具: {e}")
+                self.tools_by_server.pop(server_name, None)
+                self._functions_by_server.pop(server_name, None)
+                self._rebuild_all_tools()
+            return
+        finally:
+            self._pending_servers.pop(server_name, None)
+
+        self.servers[server_name] = server
+        # 统一重命名：serverName_toolName，并转换为 OpenAI Function Calling 所需格式
+        functions = self.transform_json(
+            [
+                {
+                    "type": "function",
+                    "function": {
+                        "name": f"{server_name}_{tool.name}",
+                        "description": tool.description,
+                        "input_schema": tool.input_schema,
+                    },
+                }
+                for tool in tools
+            ]
+        )
+        if cached is not None and cached["functions"] != functions:
+            logging.warning(f"服务器 {server_name} 的工具目录已变化，已更新缓存")
+        self.tools_by_server[server_name] = tools
+        self._functions_by_server[server_name] = functions
+        self._rebuild_all_tools()
+        if self.catalog_cache and (cached is None or cached["functions"] != functions):
+            self.catalog_cache.put(server_name, srv_config, tools, functions)
+
+    def _rebuild_all_tools(self) -> None:
+        """
+        按配置顺序重新拼接 all_tools，并重建路由表与检索索引。
+        内置的分页读取工具不在 all_tools 中，只在上下文中有转存结果时才发送。
+        "服务器名_工具名" 可能重名（如服务器 a_b 的工具 c 与服务器 a 的工具 b_c），
+        重名时保留配置中靠前的工具，后出现的记录错误后跳过，不会静默覆盖路由
+        """
+        self.all_tools = []
+        self._tool_routes = {}
+        for server_name in self._server_order:
+            for tool in self.tools_by_server.get(server_name, []):
+                full_name = f"{server_name}_{tool.name}"
+                if full_name == READ_OUTPUT_TOOL or full_name in self._tool_routes:
+                    route = self._tool_routes.get(full_name)
+                    owner = f"服务器 {route[0]} " if route else "内置"
+                    logging.error(
+                        f"工具名 {full_name} 与{owner}的工具重名，"
+                        f"已跳过服务器 {server_name} 的工具 {tool.name}"
+                    )
+                    continue
+                self._tool_routes[full_name] = (server_name, tool.name)
+            self.all_tools.extend(
+                function
+                for function in self._functions_by_server.get(server_name, [])
+                if self._tool_routes.get(function["function"]["name"], ("",))[0]
+                == server_name
+            )
+        self._tool_index = ToolIndex(self.all_tools)
+
+    def _embedder(self, model: str) -> Optional[Callable[[List[str]], Any]]:
+        """回答缓存使用的 embeddings 函数，未配置模型时返回 None（只做精确匹配）"""
+        if not model:
+            return None
+
+        async def embed(texts: List[str]) -> List[List[float]]:
+            return await self.client.embed(texts, model)
+
+        return embed
+
+    def _answer_ttl(self, messages: List[Dict[str, Any]]) -> float:
+        """
+        根据本轮调用过的工具计算回答可缓存的秒数：取各工具结果缓存 TTL 的最小值；
+        调用了不可缓存的工具（如 write_file）、工具出错或返回了不可缓存的结果时
+        返回 0，不缓存；没有调用工具时使用 toolless_ttl（默认 0）
+        """
+        if uncacheable_results.get():
+            return 0.0
+        ttl = self.answer_cache.default_ttl
+        used_tools = False
+        for message in messages:
+            if message.get("role") == "tool" and str(message["content"]).startswith(
+                '{"error"'
+            ):
+                return 0.0
+            for tool_call in message.get("tool_calls") or []:
+                name = tool_call["function"]["name"]
+                if name == READ_OUTPUT_TOOL:
+                    continue
+                route = self._tool_routes.get(name)
+                server = self.servers.get(route[0]) if route else None
+                if server is None:
+                    return 0.0
+                used_tools = True
+                ttl = min(ttl, ToolResultCache.ttl_for(server.config, route[1]))
+        return ttl if used_tools else self.answer_cache.toolless_ttl
+
+    def select_tools(
+        self, query: str, recent: Iterable[str] = ()
+    ) -> List[Dict[str, Any]]:
+        """
+        按与 query 的相关性挑选本轮发送给模型的工具子集（保持 all_tools 中的顺序）
+
+        最近使用过的工具始终保留；工具总数不超过 tool_top_k、或没有任何工具
+        与 query 相关时，仍发送全部工具，避免模型缺少需要的工具。
+        内置的分页读取工具由 _with_reader 在每次请求前按需追加。
+        """
+        if not self.tool_top_k or len(self.all_tools) <= self.tool_top_k:
+            return self.all_tools
+        ranked = self._tool_index.search(query, self.tool_top_k)
+        if not ranked:
+            return self.all_tools
+        chosen = set(ranked) | set(recent)
+        return [t for t in self.all_tools if t["function"]["name"] in chosen]
+
+    def _with_reader(
+        self, messages: List[Dict[str, Any]], tools: List[Dict[str, Any]]
     ) -> List[Dict[str, Any]]:
+        """上下文中有转存的工具结果时，在本次请求的工具列表末尾追加分页读取工具"""
+        if not self.output_store.inline_limit or not ToolOutputStore.spilled(messages):
+            return tools
+        return tools + [self.output_store.function()]
+
+    async def _start_server(
+        self, server_name: str, srv_config: Dict[str, Any]
+    ) -> Tuple[Server, List[Any]]:
+        """
+        启动单个服务器并获取其工具列表，整个过程受 startup_timeout 限制
+        """
+        server = Server(server_name, srv_config)
+        timeout = srv_config.get("startup_timeout", DEFAULT_STARTUP_TIMEOUT)
+        try:
+            async with asyncio.timeout(timeout):
+                # 回放时不启动服务器进程，工具列表与调用结果均来自 cassette
+                if not cassette.replaying:
+                    await server.initialize()
+                tools = await server.list_tools()
+        except TimeoutError:
+            await server.cleanup()
+            raise TimeoutError(f"启动超时（{timeout}s）") from None
+        except BaseException:
+            await server.cleanup()
+            raise
+        return server, tools
+
+    def transform_json(self, json_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
         将工具的 input_schema 转换为 OpenAI 所需的 parameters 格式，并删除多余字段
         """
@@ -319,50 +2396,296 @@ class MultiServerMCPClient:
             result.append(new_item)
         return result
 
-    async def chat_base(self, messages: List[Dict[str, Any]]) -> Any:
+    def new_budget(self) -> TurnBudget:
+        """按配置创建一轮对话的预算"""
+        return TurnBudget(self.turn_max_rounds, self.turn_max_tokens, self.turn_timeout)
+
+    async def chat_base(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]] = None,
+        budget: Optional[TurnBudget] = None,
+    ) -> Any:
         """
         使用 OpenAI 接口进行对话，并支持多次工具调用（Function Calling）。
         如果返回 finish_reason 为 "tool_calls"，则进行工具调用后再发起请求。
+        tools 为本轮发送的工具子集，默认发送全部工具。
+        轮数、token 或时间预算耗尽时不再调用工具，强制模型给出最终回答。
         """
-        response = self.client.get_response(messages, tools=self.all_tools)
+        tools = self.all_tools if tools is None else tools
+        budget = budget or self.new_budget()
+        rounds = 1
+        response = None
+        with tracer.span("round", round=rounds):
+            async with budget.guard():
+                response = await self.client.get_response(
+                    messages, tools=self._with_reader(messages, tools)
+                )
+        budget.charge_response(response)
         # 如果模型返回工具调用
-        if response.choices[0].finish_reason == "tool_calls":
-            while True:
+        while (
+            response is not None
+            and response.choices[0].finish_reason == "tool_calls"
+            and not budget.exhausted()
+        ):
+            rounds += 1
+            with tracer.span("round", round=rounds):
                 messages = await self.create_function_response_messages(
-                    messages, response
+                    messages, response, budget
+                )
+                response = None
+                if not budget.timed_out:
+                    async with budget.guard():
+                        response = await self.client.get_response(
+                            messages, tools=self._with_reader(messages, tools)
+                        )
+            budget.charge_response(response)
+        if response is None or response.choices[0].finish_reason == "tool_calls":
+            response = await self._final_answer(messages, tools, budget)
+        tracer.annotate(rounds=rounds)
+        return response
+
+    def _budget_note(self, budget: TurnBudget) -> Dict[str, Any]:
+        """预算耗尽时追加给模型的提示，要求其不再调用工具、直接作答"""
+        reason = budget.exhausted() or "时间"
+        logging.warning(f"Turn budget exhausted ({reason}), forcing a final answer")
+        tracer.annotate(budget_exhausted=reason)
+        return {
+            "role": "system",
+            "content": f"本轮对话的{reason}预算已用尽，不能再调用工具。"
+            "请根据目前已获得的信息直接给出最终回答，信息不足时请说明。",
+        }
+
+    async def _final_answer(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: List[Dict[str, Any]],
+        budget: TurnBudget,
+    ) -> Any:
+        """强制进行一次不允许调用工具的最终回答（提示消息不写入 messages）"""
+        note = self._budget_note(budget)
+        with tracer.span("round", final=True):
+            async with asyncio.timeout(self.turn_final_timeout or None):
+                response = await self.client.get_response(
+                    messages + [note], tools=tools, tool_choice="none"
                 )
-                response = self.client.get_response(messages, tools=self.all_tools)
-                if response.choices[0].finish_reason != "tool_calls":
-                    break
+        message = response.choices[0].message
+        # 个别模型会忽略 tool_choice，丢弃其中的工具调用，避免历史中出现未应答的调用
+        if message.tool_calls:
+            message.tool_calls = None
+            response.choices[0].finish_reason = "stop"
         return response
 
     async def create_function_response_messages(
-        self, messages: List[Dict[str, Any]], response: Any
+        self,
+        messages: List[Dict[str, Any]],
+        response: Any,
+        budget: Optional[TurnBudget] = None,
     ) -> List[Dict[str, Any]]:
         """
-        将模型返回的工具调用解析执行，并将结果追加到消息队列中
+        将模型返回的工具调用解析并发执行，并按原顺序将结果追加到消息队列中；
+        本轮时间预算耗尽时取消尚未完成的调用，以结构化错误作为其结果
         """
         function_call_messages = response.choices[0].message.tool_calls
         messages.append(response.choices[0].message.model_dump())
-        for function_call_message in function_call_messages:
-            tool_name = function_call_message.function.name
-            tool_args = json.loads(function_call_message.function.arguments)
-            # 调用 MCP 工具
-            function_response = await self._call_mcp_tool(tool_name, tool_args)
-            # 🔍 打印返回值及其类型
-            # print(f"[DEBUG] tool_name: {tool_name}")
-            # print(f"[DEBUG] tool_args: {tool_args}")
-            # print(f"[DEBUG] function_response: {function_response}")
-            # print(f"[DEBUG] type(function_response): {type(function_response)}")
+        # 先解析全部参数，再并发调用 MCP 工具；任一调用失败时取消其余调用
+        calls = [
+            (
+                function_call_message.function.name,
+                json.loads(function_call_message.function.arguments),
+            )
+            for function_call_message in function_call_messages
+        ]
+        budget = budget or TurnBudget()
+        tasks: List[asyncio.Task] = []
+        async with budget.guard():
+            async with asyncio.TaskGroup() as tg:
+                for tool_name, tool_args in calls:
+                    tasks.append(
+                        tg.create_task(self._call_mcp_tool(tool_name, tool_args))
+                    )
+        budget.tool_rounds += 1
+        # 按模型返回的顺序追加 tool 消息
+        for (tool_name, _), function_call_message, task in zip(
+            calls, function_call_messages, tasks
+        ):
             messages.append(
                 {
                     "role": "tool",
-                    "content": function_response,
+                    "content": self._task_result(tool_name, task),
                     "tool_call_id": function_call_message.id,
                 }
             )
         return messages
 
+    def _task_result(self, tool_name: str, task: asyncio.Task) -> str:
+        """取工具调用任务的结果；因预算耗尽被取消的调用返回结构化错误"""
+        if task.cancelled():
+            return self._tool_error(
+                "cancelled", tool_name, "本轮对话时间预算已用尽，工具调用已取消"
+            )
+        return task.result()
+
+    async def chat_base_stream(
+        self,
+        messages: List[Dict[str, Any]],
+        on_delta: Optional[Callable[[str], None]] = None,
+        tools: Optional[List[Dict[str, Any]]] = None,
+        budget: Optional[TurnBudget] = None,
+    ) -> Dict[str, Any]:
+        """
+        chat_base 的流式版本：文本增量到达即通过 on_delta 回调输出，
+        工具调用参数边接收边拼装，某个工具调用的参数一旦完整就立即开始执行。
+        tools 为本轮发送的工具子集，默认发送全部工具。
+        流式响应不含 usage，token 预算按本地估算累计。
+
+        Returns:
+            最终的 assistant 消息（字典格式，尚未追加到 messages 中）
+        """
+        tools = self.all_tools if tools is None else tools
+        budget = budget or self.new_budget()
+        rounds = 0
+        while not budget.exhausted():
+            rounds += 1
+            result = None
+            with tracer.span("round", round=rounds, stream=True):
+                async with budget.guard():
+                    result = await self._stream_round(
+                        messages, on_delta, self._with_reader(messages, tools)
+                    )
+            if result is None:
+                break
+            message, tool_messages = result
+            budget.tokens += sum(count_message_tokens(m) for m in messages + [message])
+            if not tool_messages:
+                tracer.annotate(rounds=rounds)
+                return message
+            budget.tool_rounds += 1
+            messages.append(message)
+            messages.extend(tool_messages)
+        tracer.annotate(rounds=rounds)
+        return await self._final_answer_stream(messages, on_delta, tools, budget)
+
+    async def _final_answer_stream(
+        self,
+        messages: List[Dict[str, Any]],
+        on_delta: Optional[Callable[[str], None]],
+        tools: List[Dict[str, Any]],
+        budget: TurnBudget,
+    ) -> Dict[str, Any]:
+        """_final_answer 的流式版本，只输出文本，忽略工具调用片段"""
+        note = self._budget_note(budget)
+        content_parts: List[str] = []
+        with tracer.span("round", final=True, stream=True):
+            async with asyncio.timeout(self.turn_final_timeout or None):
+                stream = await self.client.stream_response(
+                    messages + [note], tools=tools, tool_choice="none"
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        content_parts.append(chunk.choices[0].delta.content)
+                        if on_delta:
+                            on_delta(chunk.choices[0].delta.content)
+        return {"role": "assistant", "content": "".join(content_parts)}
+
+    async def _stream_round(
+        self,
+        messages: List[Dict[str, Any]],
+        on_delta: Optional[Callable[[str], None]],
+        tools: List[Dict[str, Any]],
+    ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """
+        执行一轮流式请求，返回 assistant 消息及对应的 tool 消息列表
+        """
+        content_parts: List[str] = []
+        # index -> {"id", "name", "arguments"}，按流式片段增量拼装
+        calls: Dict[int, Dict[str, str]] = {}
+        tasks: Dict[int, asyncio.Task] = {}
+
+        def start_call(tg: asyncio.TaskGroup, index: int, tool_args: Any) -> None:
+            call = calls[index]
+            logging.info(f"\n[ 调用工具: {call['name']}, 参数: {tool_args} ]\n")
+            # 工具调用 span 挂在本轮之下，而不是流式 LLM 调用之下
+            tasks[index] = tg.create_task(
+                self._call_mcp_tool(call["name"], tool_args), context=round_context
+            )
+
+        round_context = copy_context()
+        first_token_at: Optional[float] = None
+        t0 = time.perf_counter()
+        async with asyncio.TaskGroup() as tg:
+            with tracer.span("llm", model=self.client.model, stream=True) as llm_span:
+                stream = await self.client.stream_response(messages, tools=tools)
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        llm_span.set(ttft_ms=round((first_token_at - t0) * 1000, 3))
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        content_parts.append(delta.content)
+                        if on_delta:
+                            on_delta(delta.content)
+                    for tc in delta.tool_calls or []:
+                        # 新的工具调用开始，说明之前的调用参数已接收完毕
+                        for index in calls:
+                            if index < tc.index and index not in tasks:
+                                start_call(
+                                    tg, index, self._parse_tool_args(calls[index])
+                                )
+                        call = calls.setdefault(
+                            tc.index, {"id": "", "name": "", "arguments": ""}
+                        )
+                        if tc.id:
+                            call["id"] = tc.id
+                        if tc.function and tc.function.name:
+                            call["name"] += tc.function.name
+                        if tc.function and tc.function.arguments:
+                            call["arguments"] += tc.function.arguments
+                        if tc.index not in tasks:
+                            # 参数拼成完整 JSON 对象即可提前开始调用
+                            try:
+                                tool_args = json.loads(call["arguments"])
+                            except json.JSONDecodeError:
+                                continue
+                            if isinstance(tool_args, dict):
+                                start_call(tg, tc.index, tool_args)
+            for index in calls:
+                if index not in tasks:
+                    start_call(tg, index, self._parse_tool_args(calls[index]))
+
+        content = "".join(content_parts)
+        message: Dict[str, Any] = {"role": "assistant", "content": content}
+        if not calls:
+            return message, []
+        message["content"] = content or None
+        message["tool_calls"] = [
+            {
+                "id": calls[index]["id"],
+                "type": "function",
+                "function": {
+                    "name": calls[index]["name"],
+                    "arguments": calls[index]["arguments"],
+                },
+            }
+            for index in sorted(calls)
+        ]
+        tool_messages = [
+            {
+                "role": "tool",
+                "content": tasks[index].result(),
+                "tool_call_id": calls[index]["id"],
+            }
+            for index in sorted(calls)
+        ]
+        return message, tool_messages
+
+    @staticmethod
+    def _parse_tool_args(call: Dict[str, str]) -> Dict[str, Any]:
+        """解析流式拼装完成的工具参数，空参数视为 {}"""
+        return json.loads(call["arguments"]) if call["arguments"] else {}
+
     async def process_query(self, user_query: str) -> str:
         """
         OpenAI Function Calling 流程：
@@ -371,7 +2694,8 @@ class MultiServerMCPClient:
          3. 将工具调用结果返回给模型，获得最终回答
         """
         messages = [{"role": "user", "content": user_query}]
-        response = self.client.get_response(messages, tools=self.all_tools)
+        tools = self.select_tools(user_query)
+        response = await self.client.get_response(messages, tools=tools)
         content = response.choices[0]
         logging.info(content)
         if content.finish_reason == "tool_calls":
@@ -388,7 +2712,9 @@ class MultiServerMCPClient:
                     "tool_call_id": tool_call.id,
                 }
             )
-            response = self.client.get_response(messages, tools=self.all_tools)
+            response = await self.client.get_response(
+                messages, tools=self._with_reader(messages, tools)
+            )
             return response.choices[0].message.content
         return content.message.content
 
@@ -396,23 +2722,101 @@ class MultiServerMCPClient:
         self, tool_full_name: str, tool_args: Dict[str, Any]
     ) -> str:
         """
-        根据 "serverName_toolName" 格式调用相应 MCP 工具
+        根据 "serverName_toolName" 格式调用相应 MCP 工具（通过路由表精确查找，
+        服务器名中可以包含下划线）
         """
-        parts = tool_full_name.split("_", 1)
-        if len(parts) != 2:
-            return f"无效的工具名称: {tool_full_name}"
-        server_name, tool_name = parts
-        server = self.servers.get(server_name)
-        if not server:
-            return f"找不到服务器: {server_name}"
-        resp = await server.execute_tool(tool_name, tool_args)
+        with tracer.span("tool", tool=tool_full_name):
+            if tool_full_name == READ_OUTPUT_TOOL:
+                return self._read_tool_output(tool_args)
+            route = self._tool_routes.get(tool_full_name)
+            if route is None:
+                return f"无效的工具名称: {tool_full_name}"
+            server_name, tool_name = route
+            pending = self._pending_servers.get(server_name)
+            if pending is not None:
+                # 热启动时服务器可能仍在后台连接
+                await asyncio.shield(pending)
+            server = self.servers.get(server_name)
+            if not server:
+                return f"找不到服务器: {server_name}"
+            tracer.annotate(server=server_name)
+
+            ttl = ToolResultCache.ttl_for(server.config, tool_name)
+            if ttl > 0:
+                cache_key = ToolResultCache.make_key(server_name, tool_name, tool_args)
+                cached = self.tool_cache.get(cache_key)
+                if cached is not None:
+                    logging.info(f"Cache hit for {tool_full_name}")
+                    tracer.annotate(cache="hit")
+                    return cached
+
+            try:
+                if self.tool_scheduler is not None:
+                    async with self.tool_scheduler.slot(current_session.get()):
+                        resp = await server.execute_tool(tool_name, tool_args)
+                else:
+                    resp = await server.execute_tool(tool_name, tool_args)
+            except CircuitOpenError as e:
+                tracer.annotate(error="server_unavailable")
+                return self._tool_error(
+                    "server_unavailable",
+                    tool_full_name,
+                    f"服务器 {server_name} 暂时不可用，请稍后再试或改用其他方式回答",
+                    retry_after=round(e.retry_after, 1),
+                )
+            except TimeoutError as e:
+                tracer.annotate(error="timeout")
+                return self._tool_error("timeout", tool_full_name, str(e))
+            except Exception as e:
+                tracer.annotate(error="tool_failed")
+                return self._tool_error(
+                    "tool_failed", tool_full_name, str(e) or repr(e)
+                )
+            result = self._format_tool_result(resp)
+            # 服务器可在 _meta 中以 cacheable: false 声明结果不可缓存（如旧数据）
+            meta = getattr(resp, "meta", None) or {}
+            if meta.get("cacheable") is False:
+                tracer.annotate(cache="uncacheable")
+                marks = uncacheable_results.get()
+                if marks is not None:
+                    marks.append(tool_full_name)
+            # 只缓存成功且未声明不可缓存的调用结果
+            elif ttl > 0 and not getattr(resp, "isError", False):
+                self.tool_cache.put(cache_key, result, ttl)
+            return result
+
+    def _read_tool_output(self, tool_args: Dict[str, Any]) -> str:
+        """执行内置的分页读取工具"""
+        try:
+            return self.output_store.read(
+                str(tool_args.get("handle", "")),
+                int(tool_args.get("offset") or 0),
+                int(tool_args.get("limit") or 0) or None,
+            )
+        except (ValueError, TypeError, OSError) as e:
+            return self._tool_error("invalid_handle", READ_OUTPUT_TOOL, str(e))
+
+    @staticmethod
+    def _tool_error(
+        error_type: str, tool_full_name: str, message: str, **extra: Any
+    ) -> str:
+        """生成结构化的工具错误（JSON 字符串），便于模型据此决定下一步"""
+        error = {"type": error_type, "tool": tool_full_name, "message": message}
+        error.update(extra)
+        return json.dumps({"error": error}, ensure_ascii=False)
 
+    def server_stats(self) -> Dict[str, Dict[str, Any]]:
+        """返回各服务器的调用、重试与熔断统计"""
+        return {name: server.stats() for name, server in self.servers.items()}
+
+    def _format_tool_result(self, resp: Any) -> str:
+        """将 MCP 工具调用结果转换为字符串，过长的结果转存后只保留预览与句柄"""
         # 🛠️ 修复点：提取 TextContent 中的文本（或转成字符串）
         content = resp.content
         if isinstance(content, list):
-            # 提取所有 TextContent 对象中的 text 字段
-            texts = [c.text for c in content if hasattr(c, "text")]
-            return "\n".join(texts)
+            # 文本直接拼接，图片、音频与二进制资源转存后以占位说明代替
+            texts = [self._format_content_block(c) for c in content]
+            return self.output_store.spill("\n".join(texts))
         elif isinstance(content, dict) or isinstance(content, list):
             # 如果是 dict 或 list，但不是 TextContent 类型
             return json.dumps(content, ensure_ascii=False)
@@ -421,29 +2825,136 @@ class MultiServerMCPClient:
         else:
             return str(content)
 
-    async def chat_loop(self) -> None:
-        """多服务器 MCP + OpenAI Function Calling 客户端主循环"""
+    def _format_content_block(self, block: Any) -> str:
+        """将单个 MCP 内容块（text / image / audio / resource / resource_link）转为文本"""
+        block_type = getattr(block, "type", None)
+        if block_type in ("image", "audio"):
+            kind = "图片" if block_type == "image" else "音频"
+            return self._store_blob(kind, block.data, block.mimeType)
+        if block_type == "resource":
+            resource = block.resource
+            text = getattr(resource, "text", None)
+            if text is not None:
+                return f"[资源 {resource.uri}]\n{text}"
+            return self._store_blob(
+                f"资源 {resource.uri}", resource.blob, resource.mimeType
+            )
+        if block_type == "resource_link":
+            return f"[资源链接 {block.name}: {block.uri}]"
+        if hasattr(block, "text"):
+            return block.text
+        return json.dumps(
+            block.model_dump() if hasattr(block, "model_dump") else str(block),
+            ensure_ascii=False,
+        )
+
+    def _store_blob(self, kind: str, data: str, mime_type: Optional[str]) -> str:
+        """转存 base64 编码的二进制内容，返回给模型的占位说明"""
+        try:
+            raw = base64.b64decode(data)
+            _, path = self.output_store.put_blob(raw, mime_type)
+        except (ValueError, OSError) as e:
+            logging.warning(f"无法转存 {kind} 内容: {e}")
+            return f"[{kind}（{mime_type}），无法保存]"
+        return f"[{kind}（{mime_type}，{len(raw)} 字节），已保存至 {path}]"
+
+    async def run_turn(
+        self,
+        context: ContextWindowManager,
+        query: str,
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> Dict[str, Any]:
+        """
+        在给定的上下文中完成一轮对话，并将本轮的工具调用消息与最终回答记入历史
+
+        Args:
+            context: 会话的上下文窗口
+            query: 用户输入
+            on_delta: 传入时以流式方式请求，文本增量通过该回调输出
+
+        Returns:
+            最终的 assistant 消息（字典格式）
+        """
+        # 收集本轮返回不可缓存结果的工具，决定最终回答能否写入回答缓存
+        token = uncacheable_results.set([])
+        try:
+            with tracer.span("turn", session=current_session.get()):
+                # 只有没有历史的问题才查回答缓存，多轮对话的回答依赖上下文
+                stateless = self.answer_cache.enabled and not context.groups
+                if stateless:
+                    cached, vector = await self.answer_cache.lookup(query)
+                    if cached is not None:
+                        message = {"role": "assistant", "content": cached}
+                        if on_delta is not None:
+                            on_delta(cached)
+                        context.add([{"role": "user", "content": query}, message])
+                        return message
+                context.add([{"role": "user", "content": query}])
+                messages = context.prompt()
+                start = len(messages)
+                tools = self.select_tools(query, context.recent_tools)
+                if on_delta is not None:
+                    message = await self.chat_base_stream(
+                        messages, on_delta=on_delta, tools=tools
+                    )
+                else:
+                    response = await self.chat_base(messages, tools=tools)
+                    message = response.choices[0].message.model_dump()
+                context.add(messages[start:] + [message])
+                context.note_tools(messages[start:], self.tool_sticky)
+                if stateless:
+                    self.answer_cache.store(
+                        query,
+                        vector,
+                        message["content"],
+                        self._answer_ttl(messages[start:]),
+                    )
+                return message
+        finally:
+            uncacheable_results.reset(token)
+
+    async def chat_loop(self, stream: bool = False) -> None:
+        """多服务器 MCP + OpenAI Function Calling 客户端主循环
+
+        Args:
+            stream: 是否流式输出模型回答
+        """
         logging.info(
             "\n🤖 多服务器 MCP + Function Calling 客户端已启动！输入 'quit' 退出。"
         )
-        messages: List[Dict[str, Any]] = []
+        context = ContextWindowManager(self.client, self.context_max_tokens)
         while True:
-            query = input("\n你: ").strip()
+            # 在线程中等待输入，避免阻塞事件循环中的后台任务
+            query = (await asyncio.to_thread(input, "\n你: ")).strip()
             if query.lower() == "quit":
                 break
             try:
-                messages.append({"role": "user", "content": query})
-                messages = messages[-20:]  # 保持最新 20 条上下文
-                response = await self.chat_base(messages)
-                messages.append(response.choices[0].message.model_dump())
-                result = response.choices[0].message.content
-                # logging.info(f"\nAI: {result}")
-                print(f"\nAI: {result}")
+                if stream:
+                    print("\nAI: ", end="", flush=True)
+                    await self.run_turn(
+                        context, query, on_delta=lambda d: print(d, end="", flush=True)
+                    )
+                    print()
+                else:
+                    message = await self.run_turn(context, query)
+                    # logging.info(f"\nAI: {result}")
+                    print(f"\nAI: {message['content']}")
             except Exception as e:
                 print(f"\n⚠️  调用过程出错: {e}")
+        await context.aclose()
 
     async def cleanup(self) -> None:
         """关闭所有资源"""
+        await self.supervisor.stop()
+        for task in list(self._pending_servers.values()):
+            task.cancel()
+        await asyncio.gather(*self._pending_servers.values(), return_exceptions=True)
+        await asyncio.gather(
+            *(server.cleanup() for server in self.servers.values()),
+            return_exceptions=True,
+        )
+        if self._owns_client:
+            await self.client.close()
         await self.exit_stack.aclose()
 
 
@@ -455,9 +2966,12 @@ async def main() -> None:
     config = Configuration()
     servers_config = config.load_config("servers_config.json")
     client = MultiServerMCPClient()
+    if config.metrics_port:
+        await start_metrics_server("127.0.0.1", config.metrics_port)
+        logging.info(f"📈 指标端点: http://127.0.0.1:{config.metrics_port}/metrics")
     try:
         await client.connect_to_servers(servers_config)
-        await client.chat_loop()
+        await client.chat_loop(stream=config.stream)
     finally:
         try:
             await asyncio.sleep(0.1)
@@ -0,0 +1,293 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from client import (
+    Configuration,
+    ContextWindowManager,
+    FairScheduler,
+    MultiServerMCPClient,
+    current_session,
+    tracer,
+)
+
+# 服务模式配置
+SERVE_HOST = os.getenv("SERVE_HOST", "127.0.0.1")
+SERVE_PORT = int(os.getenv("SERVE_PORT", "8000"))
+# 同时进行的对话轮次上限，超过后新请求直接返回 503
+SERVE_MAX_ACTIVE_TURNS = int(os.getenv("SERVE_MAX_ACTIVE_TURNS", "64"))
+# 所有会话共享的工具调用并发上限与等待队列长度
+SERVE_TOOL_CONCURRENCY = int(os.getenv("SERVE_TOOL_CONCURRENCY", "16"))
+SERVE_TOOL_QUEUE = int(os.getenv("SERVE_TOOL_QUEUE", "256"))
+# 会话空闲多少秒后被清理
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+# 被拒绝时建议客户端等待的秒数
+RETRY_AFTER = 2
+
+
+# =============================
+# 会话类
+# =============================
+class ChatSession:
+    """单个对话会话：独立的上下文历史，同一会话内的轮次串行执行"""
+
+    def __init__(self, session_id: str, context: ContextWindowManager) -> None:
+        self.session_id = session_id
+        self.context = context
+        self.lock = asyncio.Lock()
+        self.last_active = time.monotonic()
+
+
+class ServiceOverloaded(Exception):
+    """工具服务器或对话并发已饱和，拒绝新的对话轮次"""
+
+
+# =============================
+# 多会话服务类
+# =============================
+class ChatService:
+    """在一个 MultiServerMCPClient 之上服务多个并发会话
+
+    所有会话共享 MCP 服务器连接与 LLM 连接池；工具调用经 FairScheduler
+    在会话之间轮转调度；工具等待队列已满或并发轮次达到上限时拒绝新请求。
+    """
+
+    def __init__(self, client: MultiServerMCPClient) -> None:
+        self.client = client
+        self.client.tool_scheduler = FairScheduler(
+            SERVE_TOOL_CONCURRENCY, SERVE_TOOL_QUEUE
+        )
+        self.sessions: Dict[str, ChatSession] = {}
+        self.active_turns = 0
+        self.rejected_turns = 0
+        self._reaper: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._reaper = asyncio.create_task(self._reap_sessions())
+
+    async def stop(self) -> None:
+        if self._reaper is not None:
+            self._reaper.cancel()
+            await asyncio.gather(self._reaper, return_exceptions=True)
+        await asyncio.gather(
+            *(session.context.aclose() for session in self.sessions.values()),
+            return_exceptions=True,
+        )
+        self.sessions.clear()
+
+    def create_session(self) -> ChatSession:
+        session_id = uuid.uuid4().hex
+        session = ChatSession(
+            session_id,
+            ContextWindowManager(self.client.client, self.client.context_max_tokens),
+        )
+        self.sessions[session_id] = session
+        return session
+
+    async def close_session(self, session_id: str) -> bool:
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        await session.context.aclose()
+        return True
+
+    async def run_turn(
+        self, session: ChatSession, query: str, on_delta: Any = None
+    ) -> Dict[str, Any]:
+        """准入检查后在会话上下文中执行一轮对话"""
+        scheduler = self.client.tool_scheduler
+        if self.active_turns >= SERVE_MAX_ACTIVE_TURNS or scheduler.saturated():
+            self.rejected_turns += 1
+            raise ServiceOverloaded("服务繁忙，请稍后重试")
+        self.active_turns += 1
+        token = current_session.set(session.session_id)
+        try:
+            async with session.lock:
+                session.last_active = time.monotonic()
+                return await self.client.run_turn(
+                    session.context, query, on_delta=on_delta
+                )
+        finally:
+            current_session.reset(token)
+            self.active_turns -= 1
+            session.last_active = time.monotonic()
+
+    async def _reap_sessions(self) -> None:
+        while True:
+            await asyncio.sleep(min(60.0, SESSION_TTL))
+            now = time.monotonic()
+            for session_id, session in list(self.sessions.items()):
+                if (
+                    not session.lock.locked()
+                    and now - session.last_active > SESSION_TTL
+                ):
+                    logging.info(f"Session {session_id} expired")
+                    await self.close_session(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self.sessions),
+            "active_turns": self.active_turns,
+            "rejected_turns": self.rejected_turns,
+            "tool_scheduler": self.client.tool_scheduler.stats(),
+            "tool_cache": self.client.tool_cache.stats(),
+            "answer_cache": self.client.answer_cache.stats(),
+            "servers": self.client.server_stats(),
+            "failed_servers": self.client.failed_servers,
+        }
+
+
+# =============================
+# HTTP / WebSocket 接口
+# =============================
+def create_app(
+    client: MultiServerMCPClient, servers_config: Dict[str, Any]
+) -> Starlette:
+    """
+    创建 Starlette 应用：
+      POST   /sessions                新建会话
+      POST   /sessions/{id}/messages  发送一轮消息，返回最终回答
+      DELETE /sessions/{id}           结束会话
+      WS     /sessions/{id}/ws        流式对话
+      GET    /stats                   运行统计
+      GET    /metrics                 Prometheus 指标
+    """
+    service = ChatService(client)
+
+    @asynccontextmanager
+    async def lifespan(app: Starlette) -> AsyncIterator[None]:
+        await client.connect_to_servers(servers_config)
+        service.start()
+        try:
+            yield
+        finally:
+            await service.stop()
+            await client.cleanup()
+
+    def get_session(session_id: str) -> Optional[ChatSession]:
+        return service.sessions.get(session_id)
+
+    async def create_session(request: Request) -> JSONResponse:
+        session = service.create_session()
+        return JSONResponse({"session_id": session.session_id}, status_code=201)
+
+    async def delete_session(request: Request) -> JSONResponse:
+        if not await service.close_session(request.path_params["session_id"]):
+            return JSONResponse({"error": "会话不存在"}, status_code=404)
+        return JSONResponse({"ok": True})
+
+    async def post_message(request: Request) -> JSONResponse:
+        session = get_session(request.path_params["session_id"])
+        if session is None:
+            return JSONResponse({"error": "会话不存在"}, status_code=404)
+        try:
+            body = await request.json()
+            query = str(body["content"]).strip()
+        except (ValueError, KeyError, TypeError):
+            return JSONResponse(
+                {"error": '请求体需为 {"content": ...}'}, status_code=400
+            )
+        try:
+            message = await service.run_turn(session, query)
+        except ServiceOverloaded as e:
+            return JSONResponse(
+                {"error": str(e)},
+                status_code=503,
+                headers={"Retry-After": str(RETRY_AFTER)},
+            )
+        except Exception as e:
+            logging.error(f"Turn failed in session {session.session_id}: {e}")
+            return JSONResponse({"error": f"调用过程出错: {e}"}, status_code=500)
+        return JSONResponse({"content": message["content"]})
+
+    async def chat_ws(websocket: WebSocket) -> None:
+        session = get_session(websocket.path_params["session_id"])
+        if session is None:
+            await websocket.close(code=4404)
+            return
+        await websocket.accept()
+        try:
+            while True:
+                data = await websocket.receive_json()
+                # 合法 JSON 但不是对象（如 "hi"、[1]）时回复错误，连接保持可用
+                if not isinstance(data, dict):
+                    await websocket.send_json(
+                        {"type": "error", "error": '消息需为 {"content": ...}'}
+                    )
+                    continue
+                query = str(data.get("content", "")).strip()
+                deltas: asyncio.Queue = asyncio.Queue()
+
+                async def forward() -> None:
+                    while (delta := await deltas.get()) is not None:
+                        await websocket.send_json({"type": "delta", "content": delta})
+
+                sender = asyncio.create_task(forward())
+                try:
+                    message = await service.run_turn(
+                        session, query, on_delta=deltas.put_nowait
+                    )
+                    reply = {"type": "done", "content": message["content"]}
+                except ServiceOverloaded as e:
+                    reply = {
+                        "type": "error",
+                        "error": str(e),
+                        "retry_after": RETRY_AFTER,
+                    }
+                except Exception as e:
+                    reply = {"type": "error", "error": f"调用过程出错: {e}"}
+                deltas.put_nowait(None)
+                await sender
+                await websocket.send_json(reply)
+        except WebSocketDisconnect:
+            pass
+        except (ValueError, json.JSONDecodeError):
+            await websocket.close(code=1003)
+
+    async def stats(request: Request) -> JSONResponse:
+        return JSONResponse(service.stats())
+
+    async def metrics(request: Request) -> PlainTextResponse:
+        return PlainTextResponse(
+            tracer.metrics.render(), media_type="text/plain; version=0.0.4"
+        )
+
+    return Starlette(
+        routes=[
+            Route("/sessions", create_session, methods=["POST"]),
+            Route("/sessions/{session_id}", delete_session, methods=["DELETE"]),
+            Route("/sessions/{session_id}/messages", post_message, methods=["POST"]),
+            WebSocketRoute("/sessions/{session_id}/ws", chat_ws),
+            Route("/stats", stats, methods=["GET"]),
+            Route("/metrics", metrics, methods=["GET"]),
+        ],
+        lifespan=lifespan,
+    )
+
+
+# =============================
+# 主函数
+# =============================
+async def main() -> None:
+    config = Configuration()
+    servers_config = config.load_config("servers_config.json")
+    client = MultiServerMCPClient()
+    app = create_app(client, servers_config)
+    server = uvicorn.Server(uvicorn.Config(app, host=SERVE_HOST, port=SERVE_PORT))
+    await server.serve()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
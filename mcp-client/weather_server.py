@@ -1,9 +1,17 @@
+import asyncio
+import logging
 import os
 import json
+import sqlite3
+import threading
+import time
 import httpx
 from typing import Any
 from dotenv import load_dotenv
 from mcp.server.fastmcp import FastMCP
+from mcp.types import CallToolResult, TextContent
+
+from city_index import build_index
 
 # 初始化 MCP 服务器
 mcp = FastMCP("WeatherServer")
@@ -11,31 +19,337 @@ mcp = FastMCP("WeatherServer")
 load_dotenv()
 
 # OpenWeather API 配置
-OPENWEATHER_API_BASE = "https://api.openweathermap.org/data/2.5/weather"
+OPENWEATHER_API_BASE = os.getenv(
+    "OPENWEATHER_API_BASE", "https://api.openweathermap.org/data/2.5/weather"
+)
 API_KEY = os.getenv("OPENWEATHER_API_KEY")
 USER_AGENT = "weather-app/1.0"
 
+# 天气结果在进程内缓存的秒数（0 表示不缓存）与最多缓存的城市数
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "300"))
+WEATHER_CACHE_MAX_ENTRIES = int(os.getenv("WEATHER_CACHE_MAX_ENTRIES", "1024"))
+# 磁盘缓存（SQLite）路径，多个服务器进程共享；为空时只使用进程内缓存。
+# 磁盘上最多保留的城市数，超出后按最近访问时间淘汰
+WEATHER_CACHE_DB = os.getenv("WEATHER_CACHE_DB", ".weather_cache.sqlite3")
+WEATHER_DB_MAX_ENTRIES = int(os.getenv("WEATHER_DB_MAX_ENTRIES", "10000"))
+# 额度耗尽（本地限流或上游 429）时，过期不超过该秒数的缓存仍可作为"旧数据"返回
+WEATHER_STALE_TTL = float(os.getenv("WEATHER_STALE_TTL", "3600"))
+# 上游请求的令牌桶限流：每分钟请求数（0 表示不限流）、突发容量与排队等待上限（秒）
+WEATHER_RATE_LIMIT = float(os.getenv("WEATHER_RATE_LIMIT", "60"))
+WEATHER_RATE_BURST = float(os.getenv("WEATHER_RATE_BURST", "10"))
+WEATHER_RATE_MAX_WAIT = float(os.getenv("WEATHER_RATE_MAX_WAIT", "2"))
+# 后台刷新旧数据时最多等待令牌的秒数
+WEATHER_REFRESH_MAX_WAIT = 60.0
+# 批量查询时同时进行的上游请求数，以及单次最多查询的城市数
+WEATHER_BATCH_CONCURRENCY = int(os.getenv("WEATHER_BATCH_CONCURRENCY", "5"))
+WEATHER_BATCH_MAX_CITIES = int(os.getenv("WEATHER_BATCH_MAX_CITIES", "20"))
+# 离线城市索引：种子 CSV 与可选的扩展别名 JSON（{"Hangzhou,CN": ["杭州"]}）
+WEATHER_CITY_CSV = os.getenv(
+    "WEATHER_CITY_CSV",
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "docs",
+        "数据",
+        "global_cities_data.csv",
+    ),
+)
+WEATHER_CITY_ALIASES = os.getenv("WEATHER_CITY_ALIASES")
 
-async def fetch_weather(city: str) -> dict[str, Any] | None:
+# 中文名、别名与拼写有误的城市名在请求上游前解析为 "Beijing,CN" 形式
+_city_index = build_index(WEATHER_CITY_CSV, WEATHER_CITY_ALIASES)
+
+# 进程级共享的 HTTP 客户端，首次使用时创建，复用到 OpenWeather 的连接
+_http_client: httpx.AsyncClient | None = None
+# 城市键 -> 正在进行的上游请求，同一城市的并发查询共享一次请求
+_in_flight: dict[str, asyncio.Future] = {}
+# 城市键 -> (获取时间（Unix 时间戳，与磁盘缓存一致）, 天气数据)
+_weather_cache: dict[str, tuple[float, dict[str, Any]]] = {}
+# 正在后台刷新的城市键，以及持有的刷新任务（防止任务被垃圾回收）
+_refreshing: set[str] = set()
+_background_tasks: set[asyncio.Task] = set()
+
+
+class TokenBucket:
+    """令牌桶限流：按固定速率补充令牌，令牌不足时排队等待，等待超过上限则放弃"""
+
+    def __init__(self, rate_per_minute: float, burst: float) -> None:
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(burst, 1.0)
+        # 可以为负数，表示已被排队中的请求预订的令牌
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.rejected = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, max_wait: float) -> bool:
+        """获取一个令牌；需要等待超过 max_wait 秒时立即返回 False"""
+        if self.rate <= 0:
+            return True
+        self._refill()
+        wait = (1 - self.tokens) / self.rate
+        if wait > max_wait:
+            self.rejected += 1
+            return False
+        self.tokens -= 1
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    def drain(self) -> None:
+        """上游返回 429 时清空令牌，后续请求按补充速率重新排队"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+_rate_limiter = TokenBucket(WEATHER_RATE_LIMIT, WEATHER_RATE_BURST)
+
+
+class WeatherDiskCache:
+    """SQLite 天气缓存，服务器进程重启或多个进程之间共享查询结果
+
+    使用 WAL 模式与 busy_timeout 支持多进程并发读写；条目数超过 max_entries 时
+    按最近访问时间（LRU）删除，过期超过旧数据窗口的条目一并清理。
+    所有方法都是同步的，由调用方通过 asyncio.to_thread 在线程中执行。
     """
-    从 OpenWeather API 获取天气信息。
+
+    def __init__(self, path: str, max_entries: int, max_age: float) -> None:
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS weather ("
+                "city_key TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                "fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS weather_accessed ON weather(accessed_at)"
+            )
+
+    def get(self, key: str) -> tuple[float, dict[str, Any]] | None:
+        """返回 (获取时间, 天气数据)，并刷新访问时间"""
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT fetched_at, data FROM weather WHERE city_key = ?", (key,)
+            ).fetchone()
+            if row is None or time.time() - row[0] > self.max_age:
+                return None
+            self._conn.execute(
+                "UPDATE weather SET accessed_at = ? WHERE city_key = ?",
+                (time.time(), key),
+            )
+        return row[0], json.loads(row[1])
+
+    def put(self, key: str, fetched_at: float, data: dict[str, Any]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO weather VALUES (?, ?, ?, ?)",
+                (key, json.dumps(data, ensure_ascii=False), fetched_at, time.time()),
+            )
+            self._writes += 1
+            # 每 64 次写入清理一次，避免每次写入都扫描全表
+            if self._writes % 64 == 1:
+                self._prune()
+
+    def _prune(self) -> None:
+        self._conn.execute(
+            "DELETE FROM weather WHERE fetched_at < ?", (time.time() - self.max_age,)
+        )
+        self._conn.execute(
+            "DELETE FROM weather WHERE city_key IN ("
+            "SELECT city_key FROM weather ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+
+def _open_disk_cache() -> WeatherDiskCache | None:
+    if not WEATHER_CACHE_DB or WEATHER_CACHE_TTL <= 0:
+        return None
+    try:
+        return WeatherDiskCache(
+            WEATHER_CACHE_DB,
+            WEATHER_DB_MAX_ENTRIES,
+            WEATHER_CACHE_TTL + WEATHER_STALE_TTL,
+        )
+    except sqlite3.Error as e:
+        logging.warning(f"无法打开天气磁盘缓存 {WEATHER_CACHE_DB}: {e}")
+        return None
+
+
+_disk_cache = _open_disk_cache()
+
+
+async def _disk_get(key: str) -> tuple[float, dict[str, Any]] | None:
+    if _disk_cache is None:
+        return None
+    try:
+        return await asyncio.to_thread(_disk_cache.get, key)
+    except (sqlite3.Error, ValueError) as e:
+        logging.warning(f"读取天气磁盘缓存失败: {e}")
+        return None
+
+
+async def _disk_put(key: str, fetched_at: float, data: dict[str, Any]) -> None:
+    if _disk_cache is None:
+        return
+    try:
+        await asyncio.to_thread(_disk_cache.put, key, fetched_at, data)
+    except sqlite3.Error as e:
+        logging.warning(f"写入天气磁盘缓存失败: {e}")
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """返回进程级共享的 HTTP 客户端；安装了 h2 时启用 HTTP/2"""
+    global _http_client
+    if _http_client is None:
+        try:
+            import h2  # noqa: F401
+
+            http2 = True
+        except ImportError:
+            http2 = False
+        _http_client = httpx.AsyncClient(
+            http2=http2,
+            headers={"User-Agent": USER_AGENT},
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return _http_client
+
+
+def resolve_city(city: str) -> str:
+    """用离线索引解析城市名，返回 OpenWeather 的查询参数；索引中没有时原样返回"""
+    match = _city_index.resolve(city)
+    return match.query if match is not None else city.strip()
+
+
+def city_key(city: str) -> str:
+    """缓存与请求合并使用的城市键：去掉首尾空白、合并连续空白并转小写"""
+    return " ".join(city.split()).lower()
+
+
+async def fetch_upstream(city: str) -> dict[str, Any]:
+    """
+    请求 OpenWeather API（不经过缓存）。
     :param city: 城市名称（需使用英文，如 Beijing）
     :return: 天气数据字典；若出错返回包含 error 信息的字典
     """
     params = {"q": city, "appid": API_KEY, "units": "metric", "lang": "zh_cn"}
-    headers = {"User-Agent": USER_AGENT}
+    try:
+        response = await get_http_client().get(OPENWEATHER_API_BASE, params=params)
+        response.raise_for_status()
+        return response.json()  # 返回字典类型
+    except httpx.HTTPStatusError as e:
+        status = e.response.status_code
+        return {"error": f"HTTP 错误: {status}", "status": status}
+    except Exception as e:
+        return {"error": f"请求失败: {str(e)}"}
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                OPENWEATHER_API_BASE, params=params, headers=headers, timeout=30.0
-            )
-            response.raise_for_status()
-            return response.json()  # 返回字典类型
-        except httpx.HTTPStatusError as e:
-            return {"error": f"HTTP 错误: {e.response.status_code}"}
-        except Exception as e:
-            return {"error": f"请求失败: {str(e)}"}
+
+def _remember(key: str, fetched_at: float, data: dict[str, Any]) -> None:
+    """写入进程内缓存"""
+    _weather_cache.pop(key, None)
+    _weather_cache[key] = (fetched_at, data)
+    while len(_weather_cache) > WEATHER_CACHE_MAX_ENTRIES:
+        # dict 保持插入顺序，先淘汰最早写入的城市
+        del _weather_cache[next(iter(_weather_cache))]
+
+
+async def _store(key: str, data: dict[str, Any]) -> None:
+    """缓存成功的结果（进程内 + 磁盘）"""
+    if WEATHER_CACHE_TTL <= 0:
+        return
+    fetched_at = time.time()
+    _remember(key, fetched_at, data)
+    await _disk_put(key, fetched_at, data)
+
+
+async def _limited_fetch(key: str, city: str, max_wait: float) -> dict[str, Any] | None:
+    """经限流器请求上游，成功时写入缓存；额度耗尽时返回 None"""
+    if not await _rate_limiter.acquire(max_wait):
+        return None
+    data = await fetch_upstream(city)
+    if data.get("status") == 429:
+        _rate_limiter.drain()
+        return None
+    if "error" not in data:
+        await _store(key, data)
+    return data
+
+
+async def _refresh(key: str, city: str) -> None:
+    """后台刷新已过期的缓存"""
+    try:
+        await _limited_fetch(key, city, WEATHER_REFRESH_MAX_WAIT)
+    finally:
+        _refreshing.discard(key)
+
+
+async def _fetch_and_cache(key: str, city: str) -> dict[str, Any]:
+    # 其他进程可能已查询过该城市；磁盘上的旧数据也载入内存，供额度耗尽时使用
+    stored = await _disk_get(key)
+    if stored is not None:
+        _remember(key, *stored)
+        if time.time() - stored[0] < WEATHER_CACHE_TTL:
+            return stored[1]
+    data = await _limited_fetch(key, city, WEATHER_RATE_MAX_WAIT)
+    if data is not None:
+        return data
+    # 额度耗尽：有不太旧的缓存时返回旧数据（带 stale 标记），并在后台刷新
+    cached = _weather_cache.get(key)
+    if cached is not None:
+        age = time.time() - cached[0]
+        if age <= WEATHER_CACHE_TTL + WEATHER_STALE_TTL:
+            if key not in _refreshing:
+                _refreshing.add(key)
+                task = asyncio.create_task(_refresh(key, city))
+                _background_tasks.add(task)
+                task.add_done_callback(_background_tasks.discard)
+            return {**cached[1], "stale": True, "age": round(age)}
+    return {"error": "天气服务请求过于频繁（额度已用尽），请稍后再试", "status": 429}
+
+
+async def fetch_weather(city: str) -> dict[str, Any] | None:
+    """
+    从 OpenWeather API 获取天气信息：进程内或磁盘缓存命中时直接返回，
+    同一城市的并发查询只向上游发送一次请求；上游请求经令牌桶限流，
+    额度耗尽时返回带 stale 标记的旧数据并在后台刷新。
+    城市名先经离线索引解析，中文名、别名与同一城市的不同写法共享缓存；
+    上游找不到该城市（404）时，再按一处拼写错误模糊匹配已知城市后重试。
+    :param city: 城市名称（中文或英文，如 北京 / Beijing）
+    :return: 天气数据字典；若出错返回包含 error 信息的字典
+    """
+    data = await _fetch_city(resolve_city(city))
+    if data.get("status") == 404:
+        match = _city_index.resolve(city, fuzzy=True)
+        if match is not None:
+            data = await _fetch_city(match.query)
+    return data
+
+
+async def _fetch_city(city: str) -> dict[str, Any]:
+    """按解析后的查询参数获取天气（缓存、请求合并与限流）"""
+    key = city_key(city)
+    cached = _weather_cache.get(key)
+    if cached is not None and time.time() - cached[0] < WEATHER_CACHE_TTL:
+        return cached[1]
+
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_and_cache(key, city))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    # shield：某个调用方被取消时不影响共享同一请求的其他调用方
+    return await asyncio.shield(task)
 
 
 def format_weather(data: dict[str, Any] | str) -> str:
@@ -65,8 +379,15 @@ def format_weather(data: dict[str, Any] | str) -> str:
     weather_list = data.get("weather", [{}])
     description = weather_list[0].get("description", "未知")
 
+    # 额度耗尽时返回的旧数据，注明数据时间
+    stale_note = ""
+    if data.get("stale"):
+        age = data["age"]
+        age_text = f"{age // 60} 分钟" if age >= 60 else f"{age} 秒"
+        stale_note = f"🕒 注意: 天气服务暂时受限，以下为约 {age_text}前的数据\n"
+
     return (
-        f"🌍 {city}, {country}\n"
+        stale_note + f"🌍 {city}, {country}\n"
         f"🌡 温度: {temp}°C\n"
         f"💧 湿度: {humidity}%\n"
         f"🌬 风速: {wind_speed} m/s\n"
@@ -74,15 +395,60 @@ def format_weather(data: dict[str, Any] | str) -> str:
     )
 
 
+def tool_result(text: str, cacheable: bool = True) -> CallToolResult:
+    """
+    构造工具结果。旧数据与错误在 _meta 中标记 cacheable: false，
+    客户端据此不把它们写入工具结果缓存与回答缓存，后台刷新后即可返回新数据。
+    """
+    meta = None if cacheable else {"cacheable": False}
+    return CallToolResult(content=[TextContent(type="text", text=text)], _meta=meta)
+
+
+def _cacheable(data: dict[str, Any]) -> bool:
+    return "error" not in data and not data.get("stale")
+
+
 @mcp.tool()
-async def query_weather(city: str) -> str:
+async def query_weather(city: str) -> CallToolResult:
     """
-    输入指定城市的英文名称，返回今日天气查询结果。
-    :param city: 城市名称（需使用英文）
+    输入指定城市的名称，返回今日天气查询结果。
+    :param city: 城市名称（中文或英文均可，如 北京 / Beijing）
     :return: 格式化后的天气信息
     """
     data = await fetch_weather(city)
-    return format_weather(data)
+    return tool_result(format_weather(data), _cacheable(data))
+
+
+@mcp.tool()
+async def query_weather_batch(cities: list[str]) -> CallToolResult:
+    """
+    一次查询多个城市的今日天气（适合比较多个城市）。
+    :param cities: 城市名称列表（中文或英文均可），如 ["北京", "Shanghai", "Tokyo"]
+    :return: 各城市格式化后的天气信息，按输入顺序排列
+    """
+    # 去重并保持顺序，同一城市只查询一次
+    unique: dict[str, str] = {}
+    for city in cities:
+        if city.strip():
+            unique.setdefault(city_key(resolve_city(city)), city.strip())
+    if not unique:
+        return tool_result("⚠️ 请至少提供一个城市名称")
+    if len(unique) > WEATHER_BATCH_MAX_CITIES:
+        return tool_result(f"⚠️ 一次最多查询 {WEATHER_BATCH_MAX_CITIES} 个城市")
+
+    semaphore = asyncio.Semaphore(WEATHER_BATCH_CONCURRENCY)
+
+    async def fetch_one(city: str) -> dict[str, Any]:
+        async with semaphore:
+            return await fetch_weather(city)
+
+    results = await asyncio.gather(*(fetch_one(city) for city in unique.values()))
+    texts = [
+        f"⚠️ {city}: {data['error']}" if "error" in data else format_weather(data)
+        for city, data in zip(unique.values(), results)
+    ]
+    # 任一城市为旧数据或出错时，整批结果都不可缓存
+    return tool_result("\n".join(texts), all(_cacheable(data) for data in results))
 
 
 if __name__ == "__main__":
@@ -1,18 +1,189 @@
+import asyncio
+import atexit
+import os
+import time
+
+from dotenv import load_dotenv
 from mcp.server.fastmcp import FastMCP
 
 # 初始化 MCP 服务器
 mcp = FastMCP("WriteServer")
 USER_AGENT = "write-app/1.0"
 
+load_dotenv()
+
+# 写入的目录与文件名模板，模板中可使用 {date}（YYYYMMDD）与 {index}（轮转序号）；
+# 模板不含 {index} 时，轮转出的文件在扩展名前加 ".序号"
+WRITE_OUTPUT_DIR = os.getenv("WRITE_OUTPUT_DIR", "output")
+WRITE_FILE_PATTERN = os.getenv("WRITE_FILE_PATTERN", "notes-{date}.md")
+# 单个文件的大小上限（字节），超出后写入下一个序号的文件（0 表示不轮转）
+WRITE_MAX_BYTES = int(os.getenv("WRITE_MAX_BYTES", str(10 * 1024 * 1024)))
+# 组提交：收到第一条写入后最多再等待的秒数与单批最多条数，整批只 fsync 一次
+WRITE_COMMIT_INTERVAL = float(os.getenv("WRITE_COMMIT_INTERVAL", "0.01"))
+WRITE_COMMIT_MAX_BATCH = int(os.getenv("WRITE_COMMIT_MAX_BATCH", "256"))
+
+
+class RotatingFile:
+    """按日期与大小轮转的追加写文件；只在写线程中使用"""
+
+    def __init__(self, directory: str, pattern: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.pattern = pattern
+        self.max_bytes = max_bytes
+        self.date = ""
+        self.index = 0
+        self.path = ""
+        self.size = 0
+        self.fd: int | None = None
+
+    def _name(self, index: int) -> str:
+        name = self.pattern.format(date=self.date, index=index)
+        if "{index" not in self.pattern and index:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}.{index}{ext}"
+        return os.path.join(self.directory, name)
+
+    def _last_index(self) -> int:
+        """当天已存在的最大序号，重启后继续追加到最新的文件"""
+        index = 0
+        while os.path.exists(self._name(index + 1)):
+            index += 1
+        return index
+
+    def _open(self, index: int) -> None:
+        # 切换文件前先让旧文件中本批已写入的记录落盘
+        self.sync()
+        self.close()
+        self.index = index
+        self.path = self._name(index)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+
+    def write(self, data: bytes) -> str:
+        """追加一条记录（不 fsync），返回记录所在文件的路径"""
+        date = time.strftime("%Y%m%d")
+        if self.fd is None or date != self.date:
+            os.makedirs(self.directory, exist_ok=True)
+            self.date = date
+            self._open(self._last_index())
+        elif self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+            self._open(self.index + 1)
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        self.size += len(data)
+        return self.path
+
+    def sync(self) -> None:
+        if self.fd is not None:
+            os.fsync(self.fd)
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class GroupCommitWriter:
+    """
+    组提交写入器：并发的写入请求进入队列，由单个写任务成批写入，
+    每批只 fsync 一次，所有请求在数据落盘后才返回。
+    """
+
+    def __init__(self, file: RotatingFile, interval: float, max_batch: int) -> None:
+        self.file = file
+        self.interval = interval
+        self.max_batch = max(max_batch, 1)
+        self.queue: asyncio.Queue | None = None
+        self.task: asyncio.Task | None = None
+        self.batches = 0
+        self.records = 0
+
+    async def write(self, data: bytes) -> str:
+        """写入一条记录并等待其落盘，返回所在文件的路径"""
+        if self.task is None or self.task.done():
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((data, future))
+        return await future
+
+    async def _collect(self) -> list[tuple[bytes, asyncio.Future]]:
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.interval
+        while len(batch) < self.max_batch:
+            if self.queue.empty():
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except TimeoutError:
+                    break
+            else:
+                batch.append(self.queue.get_nowait())
+        return batch
+
+    def _commit(self, records: list[bytes]) -> list[str]:
+        """在线程中写入一批记录，整批 fsync 一次（轮转时旧文件另行 fsync）"""
+        paths = [self.file.write(data) for data in records]
+        self.file.sync()
+        return paths
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            try:
+                paths = await asyncio.to_thread(self._commit, [d for d, _ in batch])
+            except Exception as e:
+                # 任何异常都让整批失败，不能让写任务退出后留下永远等待的调用方
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.records += len(batch)
+            for (_, future), path in zip(batch, paths):
+                if not future.done():
+                    future.set_result(path)
+
+
+def check_pattern(pattern: str) -> None:
+    """启动时检查文件名模板，占位符错误立即报告而不是在首次写入时失败"""
+    try:
+        name = pattern.format(date="20000101", index=0)
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(
+            f"WRITE_FILE_PATTERN 无效: {pattern!r}（只支持 {{date}} 与 {{index}}）: {e!r}"
+        ) from e
+    if not name or os.path.basename(name) != name:
+        raise ValueError(f"WRITE_FILE_PATTERN 必须是不含目录的文件名: {pattern!r}")
+
+
+check_pattern(WRITE_FILE_PATTERN)
+_writer = GroupCommitWriter(
+    RotatingFile(WRITE_OUTPUT_DIR, WRITE_FILE_PATTERN, WRITE_MAX_BYTES),
+    WRITE_COMMIT_INTERVAL,
+    WRITE_COMMIT_MAX_BATCH,
+)
+atexit.register(_writer.file.close)
+
 
 @mcp.tool()
 async def write_file(content: str) -> str:
     """
-    将指定内容写入本地文件。
+    将指定内容追加写入本地文件。
     :param content: 必要参数，字符串类型，用于表示需要写入文档的具体内容。
-    :return：是否成功写入
+    :return：写入的字节数与文件路径
     """
-    return "已成功写入本地文件。"
+    data = content if content.endswith("\n") else content + "\n"
+    encoded = data.encode("utf-8")
+    try:
+        path = await _writer.write(encoded)
+    except Exception as e:
+        return f"写入失败: {e}"
+    return f"已成功写入本地文件：{os.path.abspath(path)}（{len(encoded)} 字节）"
 
 
 if __name__ == "__main__":